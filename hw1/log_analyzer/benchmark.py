@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import collections
+
+import gen_log
+import log_analyzer
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class Timer(object):
+
+    def __init__(self):
+        self.nlines = 0
+        self.results = []
+
+    def run(self, stage, func, *args):
+        started = time.time()
+        result = func(*args)
+        self.results.append({
+            'stage': stage,
+            'seconds': time.time() - started,
+            'peak_rss_mb': peak_rss_mb()})
+        return result
+
+    def report(self):
+        for res in self.results:
+            res['lines'] = self.nlines
+            res['lines_per_sec'] = self.nlines / res['seconds'] if res['seconds'] else None
+        return self.results
+
+
+def bench_stages(logfile, report_path, report_size):
+    counters = collections.Counter()
+    timer = Timer()
+    lines = timer.run('read_lines', list, logfile.read_lines())
+    timer.nlines = len(lines)
+    records = timer.run('parse', list, log_analyzer.parse(lines, counters))
+    del lines
+    stats = timer.run('get_stats', log_analyzer.get_stats, records)
+    del records
+    rows = timer.run('get_rows', log_analyzer.get_rows, stats, report_size)
+    timer.run('save_report', log_analyzer.save_report, rows, report_path)
+    return timer.report()
+
+
+def bench_pipeline(logfile, report_path, report_size, backend):
+    timer = Timer()
+    timer.nlines = sum(1 for _ in logfile.read_lines())
+
+    def run():
+        if backend == 'numpy':
+            stats = log_analyzer.get_stats_columnar(logfile.read_blocks(logfile.block_size))
+            rows = log_analyzer.get_rows_columnar(stats, report_size)
+        else:
+            stats = log_analyzer.get_stats(log_analyzer.parse(logfile.read_lines()))
+            rows = log_analyzer.get_rows(stats, report_size)
+        log_analyzer.save_report(rows, report_path)
+
+    timer.run('pipeline[{0}]'.format(backend), run)
+    return timer.report()
+
+
+def print_results(results):
+    print('{0:<20} {1:>10} {2:>14} {3:>14}'.format('stage', 'seconds', 'lines/s', 'peak rss, MB'))
+    for res in results:
+        print('{0:<20} {1:>10.3f} {2:>14.0f} {3:>14.1f}'.format(
+            res['stage'], res['seconds'], res['lines_per_sec'] or 0, res['peak_rss_mb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='time log_analyzer stages on a synthetic log; compare backends with '
+                    '--mode pipeline --backend all --lines 10000000')
+    parser.add_argument('--log', help='use an existing log instead of generating one')
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--urls', type=int, default=100000)
+    parser.add_argument('--zipf', type=float, default=1.1)
+    parser.add_argument('--gzip', action='store_true', help='generate a gzipped log')
+    parser.add_argument('--report-size', type=int, default=log_analyzer.config['REPORT_SIZE'])
+    parser.add_argument('--mode', choices=['stages', 'pipeline'], default='stages',
+                        help='time each stage on materialized input or the whole streaming run')
+    parser.add_argument('--backend', choices=['python', 'numpy', 'all'], default='python')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+    if args.log is not None:
+        args.log = os.path.abspath(args.log)
+
+    # save_report looks for the template in the current directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fpath = args.log
+        if fpath is None:
+            fpath = os.path.join(tmp_dir, 'nginx-access-ui.log-20170630')
+            if args.gzip:
+                fpath += '.gz'
+            gen_log.generate_log(fpath, args.lines, args.urls, args.zipf)
+        logfile = log_analyzer.LogFile(fpath)
+        report_path = os.path.join(tmp_dir, 'report.html')
+        if args.mode == 'stages':
+            results = bench_stages(logfile, report_path, args.report_size)
+        else:
+            backends = ['python', 'numpy'] if args.backend == 'all' else [args.backend]
+            if 'numpy' in backends and log_analyzer.numpy is None:
+                sys.exit('numpy is not installed')
+            results = []
+            for backend in backends:
+                results += bench_pipeline(logfile, report_path, args.report_size, backend)
+    finally:
+        shutil.rmtree(tmp_dir)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        print_results(results)
+
+
+if __name__ == "__main__":
+    main()
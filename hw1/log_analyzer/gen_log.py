@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import gzip
+import bisect
+import random
+import argparse
+import datetime
+
+
+LINE = ('{ip} -  - [{date:%d/%b/%Y:%H:%M:%S} +0300] "{method} {url} HTTP/1.1" 200 {size} "-" '
+        '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" '
+        '"1498697422-2190034393-4708-9752759" "dc7161be3" {req_time:.3f}\n')
+
+URL_TEMPLATES = [
+    '/api/v2/banner/{0}',
+    '/api/v2/group/{0}/statistic/sites/?date_type=day&date_from=2017-06-28&date_to=2017-06-28',
+    '/api/1/photogenic_banners/list/?server_name=WIN7RB{0}',
+    '/export/appinstall_raw/2017-06-{0}/',
+    '/api/v2/internal/html5/phantomjs/queue/?wait={0}m',
+]
+
+
+class ZipfUrls(object):
+
+    def __init__(self, nurls, skew, rnd):
+        self.rnd = rnd
+        self.urls = [URL_TEMPLATES[i % len(URL_TEMPLATES)].format(i) for i in range(nurls)]
+        rnd.shuffle(self.urls)
+        weights = [1.0 / (rank ** skew) for rank in range(1, nurls + 1)]
+        total = sum(weights)
+        self.cumulative = []
+        acc = 0.0
+        for weight in weights:
+            acc += weight / total
+            self.cumulative.append(acc)
+
+    def choice(self):
+        index = bisect.bisect_left(self.cumulative, self.rnd.random())
+        return self.urls[min(index, len(self.urls) - 1)]
+
+
+def generate_log(fpath, nlines, nurls, skew=1.1, bad_ratio=0.0, seed=0,
+                 date=datetime.datetime(2017, 6, 30)):
+    rnd = random.Random(seed)
+    urls = ZipfUrls(nurls, skew, rnd)
+    if fpath.endswith('.gz'):
+        log_f = gzip.open(fpath, 'wb')
+    else:
+        log_f = open(fpath, 'wb')
+    step = datetime.timedelta(seconds=86400.0 / max(nlines, 1))
+    with log_f:
+        for i in range(nlines):
+            if bad_ratio and rnd.random() < bad_ratio:
+                log_f.write(b'"GET /broken line\n')
+                continue
+            line = LINE.format(ip='1.196.116.{0}'.format(i % 256), date=date + step * i,
+                               method='GET' if i % 10 else 'POST', url=urls.choice(),
+                               size=rnd.randint(0, 100000), req_time=rnd.expovariate(2.0))
+            log_f.write(line.encode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='generate synthetic ui_short nginx logs')
+    parser.add_argument('out_dir')
+    parser.add_argument('--files', type=int, default=1, help='number of daily logs')
+    parser.add_argument('--lines', type=int, default=1000000, help='lines per log')
+    parser.add_argument('--urls', type=int, default=100000, help='url cardinality')
+    parser.add_argument('--zipf', type=float, default=1.1, help='zipf skew of url popularity')
+    parser.add_argument('--gzip-ratio', type=float, default=0.5, help='share of gzipped logs')
+    parser.add_argument('--bad-ratio', type=float, default=0.0, help='share of unparsable lines')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    rnd = random.Random(args.seed)
+    last_date = datetime.datetime(2017, 6, 30)
+    for i in range(args.files):
+        date = last_date - datetime.timedelta(days=args.files - i - 1)
+        fname = 'nginx-access-ui.log-{0:%Y%m%d}'.format(date)
+        if rnd.random() < args.gzip_ratio:
+            fname += '.gz'
+        generate_log(os.path.join(args.out_dir, fname), args.lines, args.urls, args.zipf,
+                     args.bad_ratio, args.seed + i, date)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,76 +12,693 @@
 
 import re
 import os
-import gzip
+import io
+import zlib
+import argparse
+import collections
+import functools
+import heapq
+import itertools
+import math
+import multiprocessing
+import random
 import shutil
+import subprocess
 import json
+import logging
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 config = {
     "REPORT_SIZE": 1000,
     "REPORT_DIR": "./reports",
-    "LOG_DIR": "./log"
+    "LOG_DIR": "./log",
+    "AGGREGATION": "exact",
+    "SKETCH_K": 200,
+    "JOBS": 1,
+    "CHUNK_SIZE": 4 * 1024 * 1024,
+    "CHECKPOINT_DIR": None,
+    "CHECKPOINT_LINES": 1000000,
+    "DAYS": 1,
+    "NORMALIZE": False,
+    "QUERY": "keep",
+    "REWRITE_RULES": [],
+    "NORMALIZE_CACHE_SIZE": 100000,
+    "BACKEND": "python",
+    "GZIP_BLOCK_SIZE": 4 * 1024 * 1024,
+    "GZIP_PIPE": False,
+    "REPORT_COMPACT": False
 }
 
+LOG_NAME_REGEX = re.compile(r'nginx-access-ui\.log-\d{8}')
+
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+GZIP_PIPE_COMMANDS = [
+    ('pigz', ['-dc']),
+    ('zcat', [])
+]
+
+
+def find_executable(name):
+    for dir_path in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(dir_path, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def stream_ended(decompressor):
+    if hasattr(decompressor, 'eof'):
+        return decompressor.eof
+    # python 2 has no Decompress.eof, but flush() releases a finished stream
+    try:
+        decompressor.copy()
+    except ValueError:
+        return True
+    return False
+
+
+def gzip_blocks(gz_f, size):
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    data = b''
+    started = False
+    while True:
+        if not data:
+            data = gz_f.read(size)
+            if not data:
+                break
+            started = True
+        block = decompressor.decompress(data, size)
+        if decompressor.unused_data:
+            # next member of a multi-member (concatenated) gzip file
+            data = decompressor.unused_data
+            block += decompressor.flush()
+            decompressor = zlib.decompressobj(GZIP_WBITS)
+        else:
+            data = decompressor.unconsumed_tail
+        if block:
+            yield block
+    block = decompressor.flush()
+    if block:
+        yield block
+    if started and not stream_ended(decompressor):
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
 
 class LogFile:
 
-    def __init__(self, fpath):
+    def __init__(self, fpath, block_size=4 * 1024 * 1024, gzip_pipe=False):
         self._fpath = fpath
+        self.block_size = block_size
+        self.gzip_pipe = gzip_pipe
+
+    @property
+    def path(self):
+        return self._fpath
 
     def filename(self):
         return os.path.basename(self._fpath)
 
-    def read_lines(self):
-        if self._fpath[-2:] == 'gz':
-            log_f = gzip.open(self._fpath)
+    def is_gzip(self):
+        return self._fpath[-2:] == 'gz'
+
+    def _pipe_command(self):
+        for name, args in GZIP_PIPE_COMMANDS:
+            path = find_executable(name)
+            if path:
+                return [path] + args + [self._fpath]
+        return None
+
+    def _read_raw_blocks(self, size):
+        command = self.is_gzip() and self.gzip_pipe and self._pipe_command()
+        if command:
+            proc = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=size)
+            try:
+                while True:
+                    data = proc.stdout.read(size)
+                    if not data:
+                        break
+                    yield data
+                proc.wait()
+            finally:
+                if proc.poll() is None:
+                    proc.kill()
+                proc.stdout.close()
+                proc.wait()
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, command)
         else:
-            log_f = open(self._fpath)
-        with log_f:
+            with open(self._fpath, 'rb') as log_f:
+                if self.is_gzip():
+                    for data in gzip_blocks(log_f, size):
+                        yield data
+                else:
+                    while True:
+                        data = log_f.read(size)
+                        if not data:
+                            break
+                        yield data
+
+    def read_lines(self, start=0, end=None):
+        if self.is_gzip():
+            return self._read_gzip_lines(start, end)
+        return self._read_plain_lines(start, end)
+
+    def _read_plain_lines(self, start, end):
+        with open(self._fpath, 'rb') as log_f:
+            if start:
+                log_f.seek(start - 1)
+                log_f.readline()
+            pos = log_f.tell()
             for line in log_f:
+                if end is not None and pos >= end:
+                    break
+                pos += len(line)
                 yield line
 
+    def _read_gzip_lines(self, start, end):
+        pos = 0
+        for block in self.read_blocks(self.block_size):
+            if pos + len(block) <= start:
+                pos += len(block)
+                continue
+            for line in io.BytesIO(block):
+                if end is not None and pos >= end:
+                    return
+                if pos >= start:
+                    yield line
+                pos += len(line)
+
+    def read_blocks(self, size):
+        tail = b''
+        for data in self._read_raw_blocks(size):
+            index = data.rfind(b'\n') + 1
+            if index:
+                yield tail + data[:index]
+                tail = data[index:]
+            else:
+                tail += data
+        if tail:
+            yield tail
+
+    def split(self, parts):
+        size = os.path.getsize(self._fpath)
+        bounds = [size * i // parts for i in range(parts + 1)]
+        return list(zip(bounds[:-1], bounds[1:]))
+
     @classmethod
-    def last_logfile(cls, log_dir):
+    def last_logfile(cls, log_dir, **options):
         fnames = os.listdir(log_dir)
-        regex = re.compile(r'nginx-access-ui\.log-\d{8}')
-        log_names = [fn for fn in fnames if regex.match(fn[:28])]
+        log_names = [fn for fn in fnames if LOG_NAME_REGEX.match(fn[:28])]
         if log_names:
             log_name = sorted(log_names)[-1]
             log_path = os.path.join(log_dir, log_name)
-            return cls(log_path)
+            return cls(log_path, **options)
         else:
             return None
 
 
+def format_date(date_str):
+    return '{0}.{1}.{2}'.format(date_str[:4], date_str[4:6], date_str[6:])
+
+
 def get_report_name(log_fname):
     date_str = log_fname[20:28]
-    res = 'report-{0}.{1}.{2}.html'.format(date_str[:4], date_str[4:6], date_str[6:])
+    res = 'report-{0}.html'.format(format_date(date_str))
     return res
 
 
-def parse(lines):
-    regex = re.compile(r'"\S+ (\S+).*" \d+ \d+ ".+" ".+" ".+" ".+" ".+" ([.\d]+)$')
+def get_range_report_name(dates):
+    return 'report-{0}-{1}.html'.format(format_date(dates[0]), format_date(dates[-1]))
+
+
+LOG_REGEX = re.compile(br'"\S+ (\S+).*" \d+ \d+ ".+" ".+" ".+" ".+" ".+" ([.\d]+)$')
+
+
+def split_line(line):
+    # ui_short has 6 quoted fields; splitting from the right keeps
+    # the request intact even if the prefix is odd
+    parts = line.rsplit(b'"', 12)
+    if len(parts) != 13 or parts[4] != b' ' or parts[6] != b' ' or \
+       parts[8] != b' ' or parts[10] != b' ':
+        return None
+    status = parts[2].split()
+    if len(status) != 2 or not status[0].isdigit() or not status[1].isdigit():
+        return None
+    req_time = parts[12].strip()
+    # float() alone would also take 'nan', 'inf' and '1e3'
+    if not req_time or req_time.strip(b'.0123456789'):
+        return None
+    request = parts[1].split(b' ', 2)
+    if len(request) < 2 or not request[0] or not request[1]:
+        return None
+    try:
+        return request[1], float(req_time)
+    except ValueError:
+        return None
+
+
+def parse_fallback(line, counters):
+    counters['fallback'] += 1
+    match = LOG_REGEX.search(line)
+    if not match:
+        counters['errors'] += 1
+        return None
+    url, req_time = match.groups()
+    try:
+        return url, float(req_time)
+    except ValueError:
+        counters['errors'] += 1
+        return None
+
+
+def parse(lines, counters=None):
+    if counters is None:
+        counters = collections.Counter()
     for line in lines:
-        match = regex.search(line)
-        if match:
-            url, req_time = match.groups()
-            yield {'url': url, 'req_time': float(req_time)}
+        fields = split_line(line) or parse_fallback(line, counters)
+        if fields is not None:
+            yield {'url': fields[0], 'req_time': fields[1]}
 
 
-def get_stats(records):
-    stats = {}
+def to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+class UrlNormalizer(object):
+
+    PATH_SEGMENT = re.compile(
+        br'(?<=/)(?:(?P<uuid>[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})'
+        br'|(?P<id>\d+)'
+        br'|(?P<hex>(?=[0-9a-fA-F]*\d)[0-9a-fA-F]{8,}))(?=/|$)')
+
+    PLACEHOLDERS = {
+        'uuid': b'{uuid}',
+        'id': b'{id}',
+        'hex': b'{hex}'
+    }
+
+    def __init__(self, query='keep', rules=(), cache_size=100000):
+        self.query = query
+        self.rules = [(re.compile(to_bytes(pattern)), to_bytes(repl)) for pattern, repl in rules]
+        self.cache_size = cache_size
+        self._cache = {}
+
+    def __call__(self, url):
+        result = self._cache.get(url)
+        if result is None:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            result = self._cache[url] = self._normalize(url)
+        return result
+
+    def _normalize(self, url):
+        path, sep, query = url.partition(b'?')
+        path = self.PATH_SEGMENT.sub(self._placeholder, path)
+        if self.query == 'strip':
+            sep = query = b''
+        elif self.query == 'sort' and query:
+            query = b'&'.join(sorted(query.split(b'&')))
+        url = path + sep + query
+        for regex, repl in self.rules:
+            url = regex.sub(repl, url)
+        return url
+
+    def _placeholder(self, match):
+        return self.PLACEHOLDERS[match.lastgroup]
+
+
+def normalize(records, normalizer):
+    for record in records:
+        record['url'] = normalizer(record['url'])
+        yield record
+
+
+def read_records(lines, counters=None, normalizer=None):
+    records = parse(lines, counters)
+    if normalizer is not None:
+        records = normalize(records, normalizer)
+    return records
+
+
+def normalizer_factory(conf):
+    if not conf['NORMALIZE']:
+        return None
+    return UrlNormalizer(conf['QUERY'], conf['REWRITE_RULES'], conf['NORMALIZE_CACHE_SIZE'])
+
+
+class ExactStats(object):
+
+    def __init__(self):
+        self.times = []
+
+    def add(self, req_time):
+        self.times.append(req_time)
+
+    def merge(self, other):
+        self.times.extend(other.times)
+
+    @property
+    def count(self):
+        return len(self.times)
+
+    @property
+    def time_sum(self):
+        return sum(self.times)
+
+    @property
+    def time_max(self):
+        return max(self.times)
+
+    def median(self):
+        return median(self.times)
+
+    def quantile(self, q):
+        return exact_quantile(self.times, q)
+
+
+class KllSketch(object):
+    """Mergeable quantile sketch (Karnin, Lang, Liberty, 2016).
+
+    Keeps O(k) values whatever the stream length; the rank error of
+    a quantile is about 1.7/k with high probability (~1% for k=200).
+    """
+
+    C = 2.0 / 3.0
+
+    def __init__(self, k=200):
+        self.k = k
+        self.compactors = []
+        self.size = 0
+        self.max_size = 0
+        self._grow()
+
+    def _grow(self):
+        self.compactors.append([])
+        self.max_size = sum(self._capacity(h) for h in range(len(self.compactors)))
+
+    def _capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.C ** depth * self.k)) + 1
+
+    def update(self, value):
+        self.compactors[0].append(value)
+        self.size += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for height, items in enumerate(other.compactors):
+            self.compactors[height].extend(items)
+        self.size = sum(len(c) for c in self.compactors)
+        while self.size >= self.max_size:
+            self._compress()
+
+    def _compress(self):
+        for height in range(len(self.compactors)):
+            items = self.compactors[height]
+            if len(items) >= self._capacity(height):
+                if height + 1 >= len(self.compactors):
+                    self._grow()
+                items.sort()
+                odd = len(items) % 2
+                tail = items[-1:] if odd else []
+                offset = random.randint(0, 1)
+                self.compactors[height + 1].extend(items[offset:len(items) - odd:2])
+                self.compactors[height] = tail
+                self.size = sum(len(c) for c in self.compactors)
+                if self.size < self.max_size:
+                    break
+
+    def quantile(self, q):
+        weighted = sorted((value, 2 ** height)
+                          for height, items in enumerate(self.compactors)
+                          for value in items)
+        total = sum(weight for _, weight in weighted)
+        rank = q * total
+        cumulative = 0
+        for value, weight in weighted:
+            cumulative += weight
+            if cumulative >= rank:
+                return value
+        return weighted[-1][0]
+
+
+class SketchStats(object):
+    """Keeps raw times until there are k of them, then moves them into a KllSketch.
+
+    Most urls of a high-cardinality log are seen a few times, and a short
+    list costs no more than ExactStats for them, while an empty sketch does.
+    """
+
+    def __init__(self, k=200):
+        self.k = k
+        self.values = []
+        self.sketch = None
+
+    @property
+    def count(self):
+        if self.sketch is None:
+            return len(self.values)
+        return self._count
+
+    @property
+    def time_sum(self):
+        if self.sketch is None:
+            return sum(self.values)
+        return self._time_sum
+
+    @property
+    def time_max(self):
+        if self.sketch is None:
+            return max(self.values)
+        return self._time_max
+
+    def add(self, req_time):
+        if self.sketch is None:
+            self.values.append(req_time)
+            if len(self.values) >= self.k:
+                self._to_sketch()
+            return
+        self._count += 1
+        self._time_sum += req_time
+        if req_time > self._time_max:
+            self._time_max = req_time
+        self.sketch.update(req_time)
+
+    def _to_sketch(self):
+        self._count = len(self.values)
+        self._time_sum = sum(self.values)
+        self._time_max = max(self.values)
+        self.sketch = KllSketch(self.k)
+        for value in self.values:
+            self.sketch.update(value)
+        self.values = []
+
+    def merge(self, other):
+        if other.sketch is None:
+            for value in other.values:
+                self.add(value)
+            return
+        if self.sketch is None:
+            values = self.values
+            self.values = []
+            self._count = other.count
+            self._time_sum = other.time_sum
+            self._time_max = other.time_max
+            self.sketch = KllSketch(self.k)
+            self.sketch.merge(other.sketch)
+            for value in values:
+                self.add(value)
+            return
+        self._count += other.count
+        self._time_sum += other.time_sum
+        self._time_max = max(self._time_max, other.time_max)
+        self.sketch.merge(other.sketch)
+
+    def median(self):
+        if self.sketch is None:
+            return median(self.values)
+        return self.sketch.quantile(0.5)
+
+    def quantile(self, q):
+        if self.sketch is None:
+            return exact_quantile(self.values, q)
+        return self.sketch.quantile(q)
+
+
+def stats_factory(conf):
+    if conf['AGGREGATION'] == 'sketch':
+        return functools.partial(SketchStats, conf['SKETCH_K'])
+    return ExactStats
+
+
+def get_stats(records, stats_cls=ExactStats, stats=None):
+    if stats is None:
+        stats = {}
     for record in records:
         url = record['url']
-        req_time = record['req_time']
-        req_time_history = stats.get(url)
-        if req_time_history is None:
-            stats[url] = [req_time]
+        url_stats = stats.get(url)
+        if url_stats is None:
+            url_stats = stats[url] = stats_cls()
+        url_stats.add(record['req_time'])
+    return stats
+
+
+def merge_stats(stats, other):
+    for url, url_stats in other.items():
+        current = stats.get(url)
+        if current is None:
+            stats[url] = url_stats
         else:
-            stats[url].append(req_time)
+            current.merge(url_stats)
+    return stats
+
+
+def _range_stats(fpath, start, end, stats_cls, normalizer):
+    counters = collections.Counter()
+    lines = LogFile(fpath).read_lines(start, end)
+    return get_stats(read_records(lines, counters, normalizer), stats_cls), counters
+
+
+def _block_stats(block, stats_cls, normalizer):
+    counters = collections.Counter()
+    lines = block.splitlines(True)
+    return get_stats(read_records(lines, counters, normalizer), stats_cls), counters
+
+
+def get_stats_parallel(logfile, stats_cls, jobs, chunk_size, counters=None, normalizer=None):
+    if counters is None:
+        counters = collections.Counter()
+    if logfile.is_gzip():
+        tasks = ((_block_stats, (block, stats_cls, normalizer))
+                 for block in logfile.read_blocks(chunk_size))
+    else:
+        tasks = ((_range_stats, (logfile.path, start, end, stats_cls, normalizer))
+                 for start, end in logfile.split(jobs))
+    stats = {}
+    pending = collections.deque()
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for func, args in tasks:
+            pending.append(pool.apply_async(func, args))
+            if len(pending) > 2 * jobs:
+                part, part_counters = pending.popleft().get()
+                merge_stats(stats, part)
+                counters.update(part_counters)
+        while pending:
+            part, part_counters = pending.popleft().get()
+            merge_stats(stats, part)
+            counters.update(part_counters)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
     return stats
 
 
+def checkpoint_settings(conf):
+    # everything that changes what gets stored per url; a checkpoint saved
+    # with other settings can't be extended or merged with the current run
+    normalize = bool(conf['NORMALIZE'])
+    return {
+        'aggregation': conf['AGGREGATION'],
+        'sketch_k': conf['SKETCH_K'] if conf['AGGREGATION'] == 'sketch' else None,
+        'normalize': normalize,
+        'query': conf['QUERY'] if normalize else None,
+        'rewrite_rules': [tuple(rule) for rule in conf['REWRITE_RULES']] if normalize else []}
+
+
+class Checkpoint(object):
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.stats = {}
+        self.counters = collections.Counter()
+
+    @classmethod
+    def for_log(cls, checkpoint_dir, logfile, settings):
+        path = os.path.join(checkpoint_dir, logfile.filename() + '.ckpt')
+        return cls.load(path, settings)
+
+    @classmethod
+    def load(cls, path, settings):
+        checkpoint = cls(path, settings)
+        if os.path.exists(path):
+            with open(path, 'rb') as ckpt_f:
+                state = pickle.load(ckpt_f)
+            if state.get('settings') == settings:
+                checkpoint.offset = state['offset']
+                checkpoint.stats = state['stats']
+                checkpoint.counters = state['counters']
+            else:
+                logging.info('%s: saved with other settings, starting over', os.path.basename(path))
+        return checkpoint
+
+    def save(self):
+        state = {
+            'settings': self.settings,
+            'offset': self.offset,
+            'stats': self.stats,
+            'counters': self.counters}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as ckpt_f:
+            pickle.dump(state, ckpt_f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path)
+
+
+def update_checkpoint(logfile, checkpoint, stats_cls, batch_lines, normalizer=None, growing=False):
+    if not logfile.is_gzip() and checkpoint.offset > os.path.getsize(logfile.path):
+        checkpoint.reset()
+    lines = logfile.read_lines(checkpoint.offset)
+    while True:
+        batch = list(itertools.islice(lines, batch_lines))
+        if growing and batch and not batch[-1].endswith(b'\n'):
+            # the log is still being written, leave the partial line for the next run
+            batch.pop()
+        if not batch:
+            break
+        records = read_records(batch, checkpoint.counters, normalizer)
+        get_stats(records, stats_cls, checkpoint.stats)
+        checkpoint.offset += sum(len(line) for line in batch)
+        checkpoint.save()
+    return checkpoint.stats
+
+
+def load_daily_stats(checkpoint_dir, days, settings):
+    paths_by_date = {}
+    for fn in sorted(os.listdir(checkpoint_dir)):
+        if LOG_NAME_REGEX.match(fn[:28]) and fn.endswith('.ckpt'):
+            paths_by_date[fn[20:28]] = os.path.join(checkpoint_dir, fn)
+    dates = sorted(paths_by_date)[-days:]
+    stats = {}
+    counters = collections.Counter()
+    for date in dates:
+        checkpoint = Checkpoint.load(paths_by_date[date], settings)
+        merge_stats(stats, checkpoint.stats)
+        counters.update(checkpoint.counters)
+    return dates, stats, counters
+
+
 def median(values):
     values = sorted(values)
     if len(values) % 2 == 1:
@@ -93,56 +710,351 @@ def median(values):
         return (values[index0] + values[index1]) / 2.0
 
 
+def exact_quantile(values, q):
+    values = sorted(values)
+    index = int(math.ceil(q * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
 def get_rows(stats, max_size):
-    rows = []
-    time_total = 0
+    top = []
+    time_sums = []
     requests_total = 0
     for url in stats:
-        req_time_history = stats.get(url)
-        requests_count = len(req_time_history)
-        time_sum = sum(req_time_history)
+        url_stats = stats.get(url)
+        time_sum = url_stats.time_sum
+        time_sums.append(time_sum)
+        requests_total += url_stats.count
+        item = (time_sum, url)
+        if len(top) < max_size:
+            heapq.heappush(top, item)
+        elif item > top[0]:
+            heapq.heapreplace(top, item)
+    time_total = math.fsum(time_sums)
+    rows = []
+    for time_sum, url in sorted(top, reverse=True):
+        url_stats = stats.get(url)
+        requests_count = url_stats.count
         row = {
-            "url": url,
+            "url": url.decode('utf-8', 'replace'),
             "count": requests_count,
             "time_avg": time_sum / requests_count,
-            "time_max": max(req_time_history),
+            "time_max": url_stats.time_max,
             "time_sum": time_sum,
-            "time_med": median(req_time_history),
-            "time_perc": None,
-            "count_perc": None}
+            "time_med": url_stats.median(),
+            "time_p95": url_stats.quantile(0.95),
+            "time_p99": url_stats.quantile(0.99),
+            "time_perc": 100.0 * time_sum / time_total,
+            "count_perc": 100.0 * requests_count / requests_total}
         rows.append(row)
-        time_total += time_sum
-        requests_total += requests_count
+    return rows
+
+
+class ColumnarStats(object):
+
+    def __init__(self, urls, url_ids, times):
+        order = numpy.lexsort((times, url_ids))
+        self.urls = urls
+        self.times = times[order]
+        sorted_ids = url_ids[order]
+        # urls are ordered by id, so group i holds the times of urls[i]
+        if len(sorted_ids):
+            first = numpy.concatenate(([True], sorted_ids[1:] != sorted_ids[:-1]))
+        else:
+            # nothing parsed; reduceat can't take an index into an empty array
+            first = numpy.zeros(0, dtype=bool)
+        self.starts = numpy.flatnonzero(first)
+        self.counts = numpy.diff(numpy.append(self.starts, len(self.times)))
+        self.time_sums = numpy.add.reduceat(self.times, self.starts)
+        self.time_maxs = self.times[self.starts + self.counts - 1]
+
+    def medians(self, index):
+        starts, counts = self.starts[index], self.counts[index]
+        return (self.times[starts + (counts - 1) // 2] + self.times[starts + counts // 2]) / 2.0
+
+    def quantiles(self, index, q):
+        starts, counts = self.starts[index], self.counts[index]
+        offsets = numpy.maximum(numpy.ceil(q * counts).astype(numpy.int64) - 1, 0)
+        return self.times[starts + offsets]
+
+
+def split_columns(lines):
+    # lines are joined by a quoted NUL, so each line with the 12 quotes of
+    # ui_short takes 14 fields and field i of all lines is one slice
+    fields = lines.split(b'"')
+    nlines = (len(fields) + 1) // 14
+    if len(fields) != 14 * nlines - 1 or fields[13::14].count(b'\0') != nlines - 1:
+        return None
+    if any(fields[i::14].count(b' ') != nlines for i in (4, 6, 8, 10)):
+        return None
+    status = b' \0 '.join(fields[2::14])
+    if status.translate(None, b'0123456789 \0'):
+        return None
+    status = status.split()
+    if len(status) != 3 * nlines - 1 or status[2::3].count(b'\0') != nlines - 1:
+        return None
+    times = fields[12::14]
+    if b''.join(times).translate(None, b'.0123456789 '):
+        return None
+    request = b' \0 '.join(fields[1::14]).split(b' ')
+    if len(request) != 4 * nlines - 1 or request[3::4].count(b'\0') != nlines - 1 or \
+       b'' in request[0::4] or b'' in request[1::4]:
+        return None
+    try:
+        times = numpy.array(times).astype(numpy.float64)
+    except ValueError:
+        return None
+    return request[1::4], times
+
+
+def parse_columns(block, counters):
+    if block.endswith(b'\n'):
+        block = block[:-1]
+    chars = numpy.frombuffer(block, dtype=numpy.uint8)
+    ends = numpy.flatnonzero(chars == ord(b'\n'))
+    quotes = numpy.flatnonzero(chars == ord(b'"'))
+    odd = []
+    columns = None
+    # a line without the 12 quotes of ui_short shifts every column after it;
+    # counting them here is much cheaper than a split that won't line up
+    if len(quotes) == 12 * (len(ends) + 1):
+        columns = split_columns(block.replace(b'\n', b'"\0"'))
+    if columns is None:
+        lines = block.split(b'\n')
+        bounds = numpy.concatenate(([0], ends, [len(chars)]))
+        aligned = numpy.diff(numpy.searchsorted(quotes, bounds)) == 12
+        odd = list(itertools.compress(lines, (~aligned).tolist()))
+        lines = list(itertools.compress(lines, aligned.tolist()))
+        if lines and odd:
+            columns = split_columns(b'"\0"'.join(lines))
+        if columns is None:
+            odd += lines
+            columns = [], numpy.zeros(0, dtype=numpy.float64)
+    if not odd:
+        return columns
+    # the columns can't vouch for these lines, parse them one by one
+    fields = [split_line(line) or parse_fallback(line, counters) for line in odd]
+    fields = [item for item in fields if item is not None]
+    if not fields:
+        return columns
+    urls, times = columns
+    return (urls + [url for url, _ in fields],
+            numpy.concatenate((times, numpy.array([req_time for _, req_time in fields]))))
+
+
+def get_stats_columnar(blocks, counters=None, normalizer=None):
+    if counters is None:
+        counters = collections.Counter()
+    # a new url is interned with the number of urls seen so far as its id, so
+    # ids are dense and the whole block is mapped without a python-level loop
+    url_ids = collections.defaultdict()
+    url_ids.default_factory = url_ids.__len__
+    ids = []
+    times = []
+    for block in blocks:
+        block_urls, block_times = parse_columns(block, counters)
+        if normalizer is not None:
+            block_urls = map(normalizer, block_urls)
+        block_ids = map(url_ids.__getitem__, block_urls)
+        ids.append(numpy.fromiter(block_ids, dtype=numpy.int32, count=len(block_times)))
+        times.append(block_times)
+    urls = [None] * len(url_ids)
+    for url, url_id in url_ids.items():
+        urls[url_id] = url
+    if not ids:
+        return ColumnarStats(urls, numpy.zeros(0, dtype=numpy.int32),
+                             numpy.zeros(0, dtype=numpy.float64))
+    return ColumnarStats(urls, numpy.concatenate(ids), numpy.concatenate(times))
+
+
+def get_rows_columnar(stats, max_size):
+    time_total = math.fsum(stats.time_sums.tolist())
+    requests_total = int(stats.counts.sum())
+    index = numpy.arange(len(stats.urls))
+    if len(index) > max_size:
+        threshold = numpy.partition(stats.time_sums, len(index) - max_size)[len(index) - max_size]
+        index = numpy.flatnonzero(stats.time_sums >= threshold)
+    index = numpy.array(sorted(index, key=lambda i: (stats.time_sums[i], stats.urls[i]),
+                               reverse=True)[:max_size], dtype=numpy.int64)
+    columns = zip(index.tolist(), stats.counts[index].tolist(), stats.time_sums[index].tolist(),
+                  stats.time_maxs[index].tolist(), stats.medians(index).tolist(),
+                  stats.quantiles(index, 0.95).tolist(), stats.quantiles(index, 0.99).tolist())
+    rows = []
+    for i, requests_count, time_sum, time_max, time_med, time_p95, time_p99 in columns:
+        row = {
+            "url": stats.urls[i].decode('utf-8', 'replace'),
+            "count": requests_count,
+            "time_avg": time_sum / requests_count,
+            "time_max": time_max,
+            "time_sum": time_sum,
+            "time_med": time_med,
+            "time_p95": time_p95,
+            "time_p99": time_p99,
+            "time_perc": 100.0 * time_sum / time_total,
+            "count_perc": 100.0 * requests_count / requests_total}
+        rows.append(row)
+    return rows
+
+
+_templates = {}
+
+
+def load_template(template_path):
+    template = _templates.get(template_path)
+    if template is None:
+        with open(template_path, 'rb') as template_f:
+            head, _, tail = template_f.read().partition(b'$table_json')
+        template = _templates[template_path] = (head, tail)
+    return template
+
+
+def compact_rows(rows, digits):
     for row in rows:
-        row["time_perc"] = 100.0 * row["time_sum"] / time_total
-        row["count_perc"] = 100.0 * row["count"] / requests_total
-    rows = sorted(rows, key=lambda r: r['time_sum'], reverse=True)
-    return rows[:max_size]
+        yield dict((name, round(value, digits) if isinstance(value, float) else value)
+                   for name, value in row.items())
+
 
+def save_report(rows, file_path, template_path='./report.html', compact=False, float_digits=3,
+                chunk_rows=1000):
+    head, tail = load_template(template_path)
+    if compact:
+        encoder = json.JSONEncoder(separators=(',', ':'))
+        rows = compact_rows(rows, float_digits)
+    else:
+        encoder = json.JSONEncoder()
+    rows = iter(rows)
+    # main() takes an existing report as done, so never leave a partial one there
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as report_f:
+        report_f.write(head)
+        report_f.write(b'[')
+        separator = b''
+        while True:
+            chunk = list(itertools.islice(rows, chunk_rows))
+            if not chunk:
+                break
+            report_f.write(separator + to_bytes(encoder.encode(chunk)[1:-1]))
+            separator = to_bytes(encoder.item_separator)
+        report_f.write(b']')
+        report_f.write(tail)
+    os.rename(tmp_path, file_path)
 
-def save_report(rows, file_path):
-    with open('./report.html') as template_f, open(file_path, 'w') as report_f:
-        table_as_string = json.dumps(rows)
-        template = template_f.read()
-        s = template.replace('$table_json', table_as_string)
-        report_f.write(s)
 
+def collect_stats(logfile, conf, counters, growing=False):
+    stats_cls = stats_factory(conf)
+    normalizer = normalizer_factory(conf)
+    if conf['CHECKPOINT_DIR']:
+        checkpoint = Checkpoint.for_log(conf['CHECKPOINT_DIR'], logfile, checkpoint_settings(conf))
+        stats = update_checkpoint(logfile, checkpoint, stats_cls, conf['CHECKPOINT_LINES'],
+                                  normalizer, growing)
+        counters.update(checkpoint.counters)
+        return stats
+    if conf['JOBS'] > 1:
+        return get_stats_parallel(logfile, stats_cls, conf['JOBS'], conf['CHUNK_SIZE'], counters,
+                                  normalizer)
+    lines = logfile.read_lines()
+    records = read_records(lines, counters, normalizer)
+    return get_stats(records, stats_cls)
 
-def main(conf):
+
+def main(conf, update_only=False):
     if not os.path.exists(conf['REPORT_DIR']):
         os.makedirs(conf['REPORT_DIR'])
-    logfile = LogFile.last_logfile(conf['LOG_DIR'])
+    if conf['CHECKPOINT_DIR'] and not os.path.exists(conf['CHECKPOINT_DIR']):
+        os.makedirs(conf['CHECKPOINT_DIR'])
+    if conf['DAYS'] > 1:
+        main_days(conf)
+        return
+    logfile = LogFile.last_logfile(conf['LOG_DIR'], block_size=conf['GZIP_BLOCK_SIZE'],
+                                   gzip_pipe=conf['GZIP_PIPE'])
     if logfile is None:
         return
     report_name = get_report_name(logfile.filename())
     report_path = os.path.join(conf['REPORT_DIR'], report_name)
+    if update_only or not os.path.exists(report_path):
+        counters = collections.Counter()
+        if conf['BACKEND'] == 'numpy':
+            blocks = logfile.read_blocks(logfile.block_size)
+            stats = get_stats_columnar(blocks, counters, normalizer_factory(conf))
+            rows = get_rows_columnar(stats, conf['REPORT_SIZE'])
+        else:
+            # a plain log that is only being checkpointed may still be appended to;
+            # once a report is built from it, the log is taken as complete
+            growing = update_only and not logfile.is_gzip()
+            stats_by_url = collect_stats(logfile, conf, counters, growing)
+            if update_only:
+                rows = None
+            else:
+                rows = get_rows(stats_by_url, conf['REPORT_SIZE'])
+        logging.info('%s: %d lines parsed by regex fallback, %d unparsed',
+                     logfile.filename(), counters['fallback'], counters['errors'])
+        if rows is not None:
+            save_report(rows, report_path, compact=conf['REPORT_COMPACT'])
+
+
+def main_days(conf):
+    dates, stats_by_url, counters = load_daily_stats(conf['CHECKPOINT_DIR'], conf['DAYS'],
+                                                     checkpoint_settings(conf))
+    if not dates:
+        return
+    report_path = os.path.join(conf['REPORT_DIR'], get_range_report_name(dates))
     if not os.path.exists(report_path):
-        lines = logfile.read_lines()
-        records = parse(lines)
-        stats_by_url = get_stats(records)
+        logging.info('%d days merged: %d lines parsed by regex fallback, %d unparsed',
+                     len(dates), counters['fallback'], counters['errors'])
         rows = get_rows(stats_by_url, conf['REPORT_SIZE'])
-        save_report(rows, report_path)
+        save_report(rows, report_path, compact=conf['REPORT_COMPACT'])
 
 
 if __name__ == "__main__":
-    main(config)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=config['JOBS'],
+                        help='number of worker processes')
+    parser.add_argument('--checkpoint-dir', default=config['CHECKPOINT_DIR'],
+                        help='save per-URL aggregates here and resume from them')
+    parser.add_argument('--update-only', action='store_true',
+                        help='only advance the checkpoint of the last log, do not write a report')
+    parser.add_argument('--days', type=int, default=config['DAYS'],
+                        help='build a report for the last N days from saved checkpoints')
+    parser.add_argument('--normalize', action='store_true',
+                        help='replace numeric, uuid and hex path segments with placeholders')
+    parser.add_argument('--query', choices=['keep', 'strip', 'sort'], default=config['QUERY'],
+                        help='what to do with query strings when normalizing')
+    parser.add_argument('--rewrite', nargs=2, action='append', default=[],
+                        metavar=('PATTERN', 'REPLACEMENT'),
+                        help='extra regex rewrite applied to normalized urls')
+    parser.add_argument('--backend', choices=['python', 'numpy'], default=config['BACKEND'],
+                        help='numpy parses into arrays and aggregates them with vectorized group-by')
+    parser.add_argument('--gzip-pipe', action='store_true',
+                        help='decompress gzip logs with pigz or zcat when available')
+    parser.add_argument('--compact', action='store_true',
+                        help='write the report table as compact json with rounded floats')
+    parser.add_argument('--aggregation', choices=['exact', 'sketch'], default=config['AGGREGATION'],
+                        help='sketch keeps a bounded quantile sketch per url instead of every time')
+    parser.add_argument('--sketch-k', type=int, default=config['SKETCH_K'],
+                        help='sketch compactor capacity, larger is more accurate')
+    args = parser.parse_args()
+    if args.backend == 'numpy':
+        if numpy is None:
+            parser.error('--backend numpy requires numpy')
+        if args.jobs > 1 or args.checkpoint_dir:
+            parser.error('--backend numpy does not support --jobs and --checkpoint-dir')
+        if args.aggregation != 'exact':
+            parser.error('--backend numpy only supports exact aggregation')
+    if args.sketch_k < 2:
+        parser.error('--sketch-k must be at least 2')
+    if (args.update_only or args.days > 1) and not args.checkpoint_dir:
+        parser.error('--update-only and --days require --checkpoint-dir')
+    config['JOBS'] = args.jobs
+    config['BACKEND'] = args.backend
+    config['AGGREGATION'] = args.aggregation
+    config['SKETCH_K'] = args.sketch_k
+    config['GZIP_PIPE'] = args.gzip_pipe
+    config['REPORT_COMPACT'] = args.compact
+    config['CHECKPOINT_DIR'] = args.checkpoint_dir
+    config['DAYS'] = args.days
+    config['NORMALIZE'] = args.normalize or bool(args.rewrite)
+    config['QUERY'] = args.query
+    config['REWRITE_RULES'] = config['REWRITE_RULES'] + args.rewrite
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    main(config, args.update_only)
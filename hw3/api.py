@@ -82,12 +82,23 @@
 # Deadline: следующее занятие
 
 import abc
+import os
 import json
+import time
 import random
+import select
+import signal
 import datetime
 import logging
 import hashlib
 import uuid
+import Queue
+import httplib
+import itertools
+import threading
+import multiprocessing
+# strptime imports this lazily, which races when the first calls come from several threads
+import _strptime
 from optparse import OptionParser
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 
@@ -108,6 +119,7 @@ ERRORS = {
     INVALID_REQUEST: "Invalid Request",
     INTERNAL_ERROR: "Internal Server Error",
 }
+MAX_BATCH_SIZE = 100
 UNKNOWN = 0
 MALE = 1
 FEMALE = 2
@@ -131,7 +143,7 @@ class Field(object):
 class CharField(Field):
 
     def clean(self, value):
-        if not isinstance(value, str):
+        if not isinstance(value, basestring):
             raise ValueError
         return value
 
@@ -158,7 +170,7 @@ class PhoneField(Field):
     def clean(self, value):
         if isinstance(value, (int, long)):
             value = str(value)
-        elif type(value) is str:
+        elif isinstance(value, basestring):
             value = value.strip()
             int(value)
         else:
@@ -203,10 +215,22 @@ class ClientIDsField(Field):
         return value
 
 
+class CallsField(Field):
+
+    def clean(self, value):
+        if not isinstance(value, list) or len(value) > MAX_BATCH_SIZE or \
+                any(not isinstance(e, dict) for e in value):
+            raise ValueError
+        return value
+
+
 class RequestMeta(type):
 
     def __new__(cls, name, bases, attrs):
-        fields = {fn: attrs[fn] for fn in attrs if isinstance(attrs[fn], Field)}
+        fields = {}
+        for base in bases:
+            fields.update(getattr(base, 'fields', {}))
+        fields.update({fn: attrs[fn] for fn in attrs if isinstance(attrs[fn], Field)})
         attrs['fields'] = fields
         fields = {}
         for attr_name, value in attrs.items():
@@ -285,18 +309,30 @@ class OnlineScoreRequest(Request):
         return [fn for fn in self._params if not self._value_is_empty(self.__dict__.get(fn))]
 
 
-class MethodRequest(Request):
+class AuthRequest(Request):
     account = CharField(required=False, nullable=True)
     login = CharField(required=True, nullable=True)
     token = CharField(required=True, nullable=True)
-    arguments = ArgumentsField(required=True, nullable=True)
-    method = CharField(required=True, nullable=False)
 
     @property
     def is_admin(self):
         return self.login == ADMIN_LOGIN
 
 
+class MethodRequest(AuthRequest):
+    arguments = ArgumentsField(required=True, nullable=True)
+    method = CharField(required=True, nullable=False)
+
+
+class CallRequest(Request):
+    arguments = ArgumentsField(required=True, nullable=True)
+    method = CharField(required=True, nullable=False)
+
+
+class BatchRequest(AuthRequest):
+    calls = CallsField(required=True, nullable=False)
+
+
 class RequestHandler(object):
 
     def handle(self, method_req, req, ctx):
@@ -330,11 +366,28 @@ def check_auth(request):
     return False
 
 
+METHODS = {
+    'online_score': (OnlineScoreRequest, OnlineScoreHandler),
+    'clients_interests': (ClientsInterestsRequest, ClientsInterestsHandler)
+}
+
+
+def call_method(auth_request, method_request, ctx):
+    response, code = None, None
+    req_cls, handler = METHODS.get(method_request.method, (None, None))
+    if req_cls:
+        req = req_cls(method_request.arguments)
+        if req.is_valid():
+            code, response = handler().handle(auth_request, req, ctx)
+        else:
+            code = INVALID_REQUEST
+            response = req.errmsg()
+    else:
+        code = NOT_FOUND
+    return response, code
+
+
 def method_handler(request, ctx):
-    method_to_request_handler = {
-        'online_score': (OnlineScoreRequest, OnlineScoreHandler),
-        'clients_interests': (ClientsInterestsRequest, ClientsInterestsHandler)
-    }
     response, code = None, None
     method_request = MethodRequest(request['body'])
     if not method_request.is_valid():
@@ -343,22 +396,49 @@ def method_handler(request, ctx):
     elif not check_auth(method_request):
         code = FORBIDDEN
     else:
-        req_cls, handler = method_to_request_handler.get(method_request.method, (None, None))
-        if req_cls:
-            req = req_cls(method_request.arguments)
-            if req.is_valid():
-                code, response = handler().handle(method_request, req, ctx)
+        response, code = call_method(method_request, method_request, ctx)
+    return response, code
+
+
+# {"account": ..., "login": ..., "token": ..., "calls": [{"method": ..., "arguments": {...}}, ...]}
+# -> {"code": 200, "response": [{"code": 200, "response": {...}}, {"code": 422, "error": "..."}, ...]}
+def batch_handler(request, ctx):
+    response, code = None, None
+    batch_request = BatchRequest(request['body'])
+    if not batch_request.is_valid():
+        code = INVALID_REQUEST
+        response = batch_request.errmsg()
+    elif not check_auth(batch_request):
+        code = FORBIDDEN
+    else:
+        code, response = OK, []
+        ctx['calls'] = []
+        for call in batch_request.calls:
+            call_ctx = {}
+            call_request = CallRequest(call)
+            if not call_request.is_valid():
+                call_response, call_code = call_request.errmsg(), INVALID_REQUEST
             else:
-                code = INVALID_REQUEST
-                response = req.errmsg()
-        else:
-            code = NOT_FOUND
+                try:
+                    call_response, call_code = call_method(batch_request, call_request, call_ctx)
+                except Exception, e:
+                    logging.exception("Unexpected error: %s" % e)
+                    call_response, call_code = None, INTERNAL_ERROR
+            ctx['calls'].append(call_ctx)
+            response.append(make_response(call_response, call_code))
     return response, code
 
 
+def make_response(response, code):
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
-        "method": method_handler
+        "method": method_handler,
+        "batch": batch_handler
     }
 
     def get_request_id(self, headers):
@@ -368,6 +448,7 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
         response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
         request = None
+        data_string = None
         try:
             data_string = self.rfile.read(int(self.headers['Content-Length']))
             request = json.loads(data_string)
@@ -386,30 +467,269 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
             else:
                 code = NOT_FOUND
 
+        r = make_response(response, code)
+        body = json.dumps(r)
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if data_string is None:
+            # the body wasn't read, so the rest of the stream can't be trusted
+            self.send_header("Connection", "close")
         self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
-        else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
         context.update(r)
         logging.info(context)
-        self.wfile.write(json.dumps(r))
+        self.wfile.write(body)
         return
 
 
+class KeepAliveHTTPHandler(MainHTTPHandler):
+    # HTTP/1.1 keeps the connection open between requests; each response goes out
+    # in one buffered write, as small header writes stall on Nagle with keep-alive
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    # only a request stalled halfway holds a worker, and for this long at most;
+    # idle connections wait in the server's poller instead
+    timeout = 5
+
+    def __init__(self, request, client_address, server):
+        # unlike BaseRequestHandler, don't serve here: the server runs handle()
+        # each time the connection becomes readable and parks it in between
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self.input_buffered():
+            self.handle_one_request()
+
+    def input_buffered(self):
+        # pipelined requests may already sit in the read buffer, where
+        # polling the socket won't see them
+        buf = self.rfile._rbuf
+        buf.seek(0, 2)
+        return buf.tell() > 0
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """Serves requests with a fixed pool of threads.
+
+    A worker serves one request of a connection and hands the connection
+    to a poller thread, which queues it again once the next request
+    arrives, so idle keep-alive clients don't take up the pool.
+    """
+
+    def __init__(self, server_address, handler_class, workers, keepalive_timeout=15):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.workers = workers
+        self.keepalive_timeout = keepalive_timeout
+        self.requests = Queue.Queue()
+        self.parked = Queue.Queue()
+        self.wakeup = None
+
+    def serve_forever(self, *args):
+        # threads don't survive fork, so preforked children start their own pool here
+        self.wakeup = os.pipe()
+        for target in [self._watch_idle] + [self._work] * self.workers:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        HTTPServer.serve_forever(self, *args)
+
+    def process_request(self, request, client_address):
+        # a new connection waits for its first request like an idle one
+        self.park(self.RequestHandlerClass(request, client_address, self))
+
+    def park(self, handler):
+        self.parked.put(handler)
+        os.write(self.wakeup[1], "x")
+
+    def close_handler(self, handler):
+        handler.finish()
+        self.shutdown_request(handler.request)
+
+    def _work(self):
+        while True:
+            handler = self.requests.get()
+            try:
+                handler.handle()
+            except Exception:
+                self.handle_error(handler.request, handler.client_address)
+                handler.close_connection = 1
+            if handler.close_connection:
+                self.close_handler(handler)
+            else:
+                self.park(handler)
+
+    def _watch_idle(self):
+        poller = select.poll()
+        poller.register(self.wakeup[0], select.POLLIN)
+        idle = {}
+        while True:
+            timeout = None
+            if idle:
+                deadline = min(expires for _, expires in idle.values())
+                timeout = max(0, int((deadline - time.time()) * 1000) + 1)
+            for fd, _ in poller.poll(timeout):
+                if fd == self.wakeup[0]:
+                    os.read(fd, 4096)
+                    continue
+                # readable, hung up or failed: a worker finds out which
+                poller.unregister(fd)
+                self.requests.put(idle.pop(fd)[0])
+            now = time.time()
+            while not self.parked.empty():
+                handler = self.parked.get()
+                fd = handler.connection.fileno()
+                poller.register(fd, select.POLLIN)
+                idle[fd] = (handler, now + self.keepalive_timeout)
+            for fd, (handler, expires) in idle.items():
+                if expires <= now:
+                    poller.unregister(fd)
+                    del idle[fd]
+                    self.close_handler(handler)
+
+
+def make_server(port, workers=0, keepalive_timeout=15, handler_class=None):
+    if not workers:
+        return HTTPServer(("localhost", port), handler_class or MainHTTPHandler)
+    return ThreadPoolHTTPServer(("localhost", port), handler_class or KeepAliveHTTPHandler,
+                                workers, keepalive_timeout)
+
+
+def serve_prefork(server, processes):
+    children = []
+    for _ in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+
+def serve(server, processes):
+    if processes > 1:
+        serve_prefork(server, processes)
+    else:
+        server.serve_forever()
+
+
+def benchmark_request(method):
+    request = {"account": "horns&hoofs", "login": "h&f", "method": method}
+    request["token"] = hashlib.sha512(request["account"] + request["login"] + SALT).hexdigest()
+    if method == "online_score":
+        request["arguments"] = {"phone": "79175002040", "email": "stupnikov@otus.ru",
+                                "gender": 1, "birthday": "01.01.1990"}
+    else:
+        request["arguments"] = {"client_ids": range(10), "date": "20.07.2017"}
+    return json.dumps(request)
+
+
+def benchmark_method(port, method, requests, clients):
+    payload = benchmark_request(method)
+    counter = itertools.count()
+    errors = []
+
+    def client():
+        conn = httplib.HTTPConnection("localhost", port, timeout=30)
+        while next(counter) < requests:
+            try:
+                conn.request("POST", "/method/", payload, {"Content-Type": "application/json"})
+                resp = conn.getresponse()
+                if json.loads(resp.read()).get("code") != OK:
+                    errors.append(resp.status)
+            except Exception as e:
+                errors.append(e)
+                conn.close()
+        conn.close()
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return requests / (time.time() - started), len(errors)
+
+
+def run_benchmark(requests, clients, workers, processes):
+    setups = [
+        ("serial", 0, 1),
+        ("threads x%s" % workers, workers, 1),
+        ("prefork %s x threads x%s" % (processes, workers), workers, processes),
+    ]
+    print "%-28s %-18s %10s %7s" % ("server", "method", "req/s", "errors")
+    for name, setup_workers, setup_processes in setups:
+        server = make_server(0, setup_workers)
+        pid = os.fork()
+        if pid == 0:
+            # the request log would only measure the terminal
+            os.dup2(os.open(os.devnull, os.O_WRONLY), 2)
+            try:
+                serve(server, setup_processes)
+            except (KeyboardInterrupt, SystemExit):
+                pass
+            finally:
+                os._exit(0)
+        server.server_close()
+        try:
+            for method in ("online_score", "clients_interests"):
+                rps, errors = benchmark_method(server.server_address[1], method, requests, clients)
+                print "%-28s %-18s %10.1f %7d" % (name, method, rps, errors)
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-w", "--workers", action="store", type=int, default=0,
+                  help="serve with a pool of N threads and keep-alive, 0 is the serial server; "
+                       "idle connections don't hold a thread, a request stalled halfway does")
+    op.add_option("--processes", action="store", type=int, default=1,
+                  help="prefork N processes sharing the listening socket")
+    op.add_option("--keepalive-timeout", action="store", type=float, default=15,
+                  help="close keep-alive connections idle for this many seconds")
+    op.add_option("--bench", action="store_true", default=False,
+                  help="compare serial, threaded and preforked servers and exit")
+    op.add_option("--bench-requests", action="store", type=int, default=2000)
+    op.add_option("--bench-clients", action="store", type=int, default=8)
     (opts, args) = op.parse_args()
+    if opts.bench:
+        run_benchmark(opts.bench_requests, opts.bench_clients, opts.workers or 8,
+                      opts.processes if opts.processes > 1 else max(2, multiprocessing.cpu_count()))
+        raise SystemExit(0)
     logging.basicConfig(filename=opts.log, level=logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
+    server = make_server(opts.port, opts.workers, opts.keepalive_timeout)
     logging.info("Starting server at %s" % opts.port)
     try:
-        server.serve_forever()
+        serve(server, opts.processes)
     except KeyboardInterrupt:
         pass
     server.server_close()
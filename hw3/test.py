@@ -1,6 +1,10 @@
+import json
+import socket
+import httplib
 import hashlib
 import datetime
 import functools
+import threading
 import unittest
 
 import api
@@ -25,6 +29,9 @@ class TestSuite(unittest.TestCase):
     def get_response(self, request):
         return api.method_handler({"body": request, "headers": self.headers}, self.context)
 
+    def get_batch_response(self, request):
+        return api.batch_handler({"body": request, "headers": self.headers}, self.context)
+
     def set_valid_auth(self, request):
         if request.get("login") == api.ADMIN_LOGIN:
             request["token"] = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
@@ -136,5 +143,163 @@ class TestSuite(unittest.TestCase):
                         for v in response.values()))
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
 
+    def test_ok_batch_request(self):
+        calls = [
+            {"method": "online_score", "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}},
+            {"method": "clients_interests", "arguments": {"client_ids": [1, 2]}},
+            {"method": "clients_interests", "arguments": {"client_ids": []}},
+            {"method": "unknown", "arguments": {}},
+            {"arguments": {}},
+        ]
+        request = {"account": "horns&hoofs", "login": "h&f", "calls": calls}
+        self.set_valid_auth(request)
+        response, code = self.get_batch_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual([api.OK, api.OK, api.INVALID_REQUEST, api.NOT_FOUND, api.INVALID_REQUEST],
+                         [r["code"] for r in response])
+        self.assertTrue(response[0]["response"]["score"] >= 0)
+        self.assertEqual(2, len(response[1]["response"]))
+        self.assertTrue(all(r["error"] for r in response[2:]))
+        self.assertEqual(sorted(self.context["calls"][0]["has"]), ["email", "phone"])
+        self.assertEqual(self.context["calls"][1]["nclients"], 2)
+
+    def test_batch_checks_auth_once(self):
+        calls = [{"method": "online_score", "arguments": {"first_name": "a", "last_name": "b"}}] * 5
+        request = {"account": "horns&hoofs", "login": "admin", "calls": calls}
+        self.set_valid_auth(request)
+        check_auth, checked = api.check_auth, []
+        api.check_auth = lambda req: checked.append(req) or check_auth(req)
+        try:
+            response, code = self.get_batch_response(request)
+        finally:
+            api.check_auth = check_auth
+        self.assertEqual(api.OK, code)
+        self.assertEqual(1, len(checked))
+        self.assertEqual([42] * 5, [r["response"]["score"] for r in response])
+
+    def test_bad_auth_batch_request(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "token": "sdd",
+                   "calls": [{"method": "online_score", "arguments": {}}]}
+        _, code = self.get_batch_response(request)
+        self.assertEqual(api.FORBIDDEN, code)
+
+    @cases([
+        {"account": "horns&hoofs", "login": "h&f"},
+        {"account": "horns&hoofs", "login": "h&f", "calls": []},
+        {"account": "horns&hoofs", "login": "h&f", "calls": {"method": "online_score"}},
+        {"account": "horns&hoofs", "login": "h&f", "calls": ["online_score"]},
+        {"account": "horns&hoofs", "login": "h&f",
+         "calls": [{"method": "clients_interests", "arguments": {"client_ids": [1]}}] * (api.MAX_BATCH_SIZE + 1)},
+    ])
+    def test_invalid_batch_request(self, request):
+        self.set_valid_auth(request)
+        response, code = self.get_batch_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code)
+        self.assertTrue(len(response))
+
+
+class QuietHandler(api.KeepAliveHTTPHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class TestThreadPoolServer(unittest.TestCase):
+    def setUp(self):
+        self.server = api.make_server(0, workers=2, keepalive_timeout=5, handler_class=QuietHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, conn, body):
+        conn.request("POST", "/method/", body, {"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        return resp, json.loads(resp.read())
+
+    def test_keep_alive(self):
+        conn = httplib.HTTPConnection("localhost", self.port, timeout=5)
+        for method in ("online_score", "clients_interests", "online_score"):
+            resp, data = self.post(conn, api.benchmark_request(method))
+            self.assertEqual(api.OK, data["code"], data)
+            self.assertEqual(resp.version, 11)
+            self.assertFalse(resp.will_close)
+        conn.close()
+
+    def test_batch(self):
+        request = json.loads(api.benchmark_request("online_score"))
+        request["calls"] = [{"method": "online_score", "arguments": request.pop("arguments")},
+                            {"method": "clients_interests", "arguments": {"client_ids": [1, 2, 3]}}]
+        conn = httplib.HTTPConnection("localhost", self.port, timeout=5)
+        conn.request("POST", "/batch/", json.dumps(request), {"Content-Type": "application/json"})
+        data = json.loads(conn.getresponse().read())
+        conn.close()
+        self.assertEqual(api.OK, data["code"], data)
+        self.assertEqual([api.OK, api.OK], [r["code"] for r in data["response"]])
+        self.assertEqual(3, len(data["response"][1]["response"]))
+
+    def test_bad_request_closes_connection(self):
+        conn = httplib.HTTPConnection("localhost", self.port, timeout=5)
+        resp, data = self.post(conn, "{not json")
+        self.assertEqual(api.BAD_REQUEST, data["code"])
+        self.assertFalse(resp.will_close)
+        # no Content-Length, so the server can't tell where the next request starts
+        conn.putrequest("POST", "/method/")
+        conn.endheaders()
+        resp = conn.getresponse()
+        self.assertEqual(api.BAD_REQUEST, json.loads(resp.read())["code"])
+        self.assertTrue(resp.will_close)
+        conn.close()
+
+    def test_idle_client_does_not_block_others(self):
+        idle = socket.create_connection(("localhost", self.port))
+        idle.sendall("POST /method/ HTTP/1.1\r\n")
+        try:
+            conn = httplib.HTTPConnection("localhost", self.port, timeout=2)
+            _, data = self.post(conn, api.benchmark_request("clients_interests"))
+            self.assertEqual(api.OK, data["code"])
+            self.assertEqual(10, len(data["response"]))
+            conn.close()
+        finally:
+            idle.close()
+
+    def test_idle_connections_do_not_hold_workers(self):
+        # more idle connections than workers: served once, and one that never sent anything
+        idle = []
+        try:
+            for _ in range(3):
+                conn = httplib.HTTPConnection("localhost", self.port, timeout=2)
+                _, data = self.post(conn, api.benchmark_request("online_score"))
+                self.assertEqual(api.OK, data["code"])
+                idle.append(conn)
+            idle.append(socket.create_connection(("localhost", self.port)))
+            conn = httplib.HTTPConnection("localhost", self.port, timeout=2)
+            _, data = self.post(conn, api.benchmark_request("clients_interests"))
+            self.assertEqual(api.OK, data["code"])
+            conn.close()
+            for conn in idle[:3]:
+                _, data = self.post(conn, api.benchmark_request("clients_interests"))
+                self.assertEqual(api.OK, data["code"])
+        finally:
+            for conn in idle:
+                conn.close()
+
+    def test_pipelined_requests(self):
+        body = api.benchmark_request("online_score")
+        request = "POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+        sock = socket.create_connection(("localhost", self.port), timeout=2)
+        try:
+            sock.sendall(request * 3)
+            for _ in range(3):
+                resp = httplib.HTTPResponse(sock)
+                resp.begin()
+                self.assertEqual(api.OK, json.loads(resp.read())["code"])
+        finally:
+            sock.close()
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import errno
+import shlex
+import bisect
+import random
+import select
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+import collections
+import multiprocessing
+
+
+FIXTURES = {
+    'small.html': 512,
+    '10k.bin': 10 * 1024,
+    '100k.bin': 100 * 1024,
+    'image.jpg': 1024 * 1024,
+}
+
+SCENARIOS = {
+    'small': [('/small.html', 1)],
+    'image': [('/image.jpg', 1)],
+    # a new path every time, so negative lookups can't be cached
+    '404': [('/missing-%d.html', 1)],
+    'slowloris': [('/small.html', 1)],
+    'mix': [('/small.html', 70), ('/10k.bin', 20), ('/100k.bin', 9), ('/image.jpg', 1)],
+}
+
+
+def make_root(root):
+    for name, size in FIXTURES.items():
+        with open(os.path.join(root, name), 'wb') as f:
+            if name.endswith('.html'):
+                f.write((b'<html>' + b'x' * size)[:size - 7] + b'</html>')
+            else:
+                f.write(os.urandom(size))
+
+
+def parse_mix(value):
+    mix = []
+    for item in value.split(','):
+        path, _, weight = item.partition(':')
+        mix.append((path if path.startswith('/') else '/' + path, float(weight or 1)))
+    return mix
+
+
+class Client(object):
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.sock = None
+        self.connecting = False
+        self.out = b''
+        self.buf = bytearray()
+        self.started = None
+        self.header_end = None
+        self.length = None
+        self.status = None
+        self.closing = False
+
+    def start_request(self, path, now):
+        self.started = now
+        self.buf = bytearray()
+        self.header_end = None
+        self.length = None
+        self.status = None
+        self.closing = False
+        connection = 'keep-alive' if self.runner.keep_alive else 'close'
+        self.out = ('GET %s HTTP/1.1\r\nHost: %s\r\nConnection: %s\r\n\r\n' % (
+            path, self.runner.host, connection)).encode('latin-1')
+        if self.sock is None:
+            self._connect()
+        else:
+            self.runner.epoll.modify(self.sock.fileno(), select.EPOLLIN | select.EPOLLOUT)
+
+    def _connect(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        code = self.sock.connect_ex((self.runner.host, self.runner.port))
+        if code not in (0, errno.EINPROGRESS):
+            self.fail('connect')
+            return
+        self.connecting = True
+        self.runner.register(self, select.EPOLLIN | select.EPOLLOUT)
+
+    def on_event(self, event, now):
+        if self.connecting:
+            if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                self.fail('connect')
+                return
+            if not event & select.EPOLLOUT:
+                return
+            self.connecting = False
+        if event & select.EPOLLOUT and self.out:
+            try:
+                nbytes = self.sock.send(self.out)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.fail('send')
+                return
+            self.out = self.out[nbytes:]
+            if not self.out:
+                self.runner.epoll.modify(self.sock.fileno(), select.EPOLLIN)
+        if event & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+            self._read(now)
+
+    def _read(self, now):
+        try:
+            data = self.sock.recv(self.runner.recv_size)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.fail('reset')
+            return
+        if not data:
+            if self.header_end is not None and self.length is None:
+                self.finish(now)
+            else:
+                self.fail('closed')
+            return
+        self.buf += data
+        if self.header_end is None:
+            index = self.buf.find(b'\r\n\r\n')
+            if index == -1:
+                return
+            self.header_end = index + 4
+            lines = bytes(self.buf[:index]).decode('latin-1').split('\r\n')
+            self.status = int(lines[0].split(' ', 2)[1])
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                name = name.strip().lower()
+                if name == 'content-length':
+                    self.length = int(value)
+                elif name == 'connection':
+                    self.closing = value.strip().lower() == 'close'
+        if self.length is not None and len(self.buf) - self.header_end >= self.length:
+            self.finish(now)
+
+    def finish(self, now):
+        self.started, started = None, self.started
+        self.runner.record(self.status, now - started, len(self.buf))
+        if self.closing or not self.runner.keep_alive:
+            self.close()
+        self.runner.next_request(self, now)
+
+    def fail(self, reason):
+        self.started = None
+        self.close()
+        self.runner.record_error(reason)
+
+    def close(self):
+        if self.sock is not None:
+            self.runner.unregister(self)
+            self.sock.close()
+            self.sock = None
+        self.connecting = False
+
+
+class SlowClient(object):
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.sock = None
+        self.dropped = False
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.sock.connect((self.runner.host, self.runner.port))
+            self.sock.sendall(('GET /small.html HTTP/1.1\r\nHost: %s\r\n' %
+                               self.runner.host).encode('latin-1'))
+        except socket.error:
+            self.drop()
+            return
+        self.sock.setblocking(0)
+        self.runner.register(self, select.EPOLLIN)
+
+    def tick(self):
+        # trickle one more header line so the request never completes
+        if self.sock is not None:
+            try:
+                self.sock.send(b'X-Slow: 1\r\n')
+            except socket.error:
+                self.drop()
+
+    def on_event(self, event, now):
+        self.drop()
+
+    def drop(self):
+        self.dropped = True
+        self.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.runner.unregister(self)
+            self.sock.close()
+            self.sock = None
+
+
+class Runner(object):
+
+    def __init__(self, host, port, mix, requests, concurrency, keep_alive=True,
+                 timeout=10, slow_clients=0, slow_interval=1, recv_size=262144):
+        self.host = host
+        self.port = port
+        self.paths = [path for path, _ in mix]
+        self.cumulative = []
+        for _, weight in mix:
+            self.cumulative.append(weight + (self.cumulative[-1] if self.cumulative else 0))
+        self.requests = requests
+        self.concurrency = concurrency
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.slow_clients = slow_clients
+        self.slow_interval = slow_interval
+        self.recv_size = recv_size
+        self.epoll = None
+        self.handlers = {}
+        self.issued = 0
+        self.completed = 0
+        self.latencies = []
+        self.statuses = collections.Counter()
+        self.errors = collections.Counter()
+        self.bytes_received = 0
+
+    def register(self, handler, events):
+        self.handlers[handler.sock.fileno()] = handler
+        self.epoll.register(handler.sock.fileno(), events)
+
+    def unregister(self, handler):
+        fileno = handler.sock.fileno()
+        if self.handlers.pop(fileno, None) is not None:
+            self.epoll.unregister(fileno)
+
+    def record(self, status, latency, nbytes):
+        self.completed += 1
+        self.statuses[status] += 1
+        self.latencies.append(latency)
+        self.bytes_received += nbytes
+
+    def record_error(self, reason):
+        self.completed += 1
+        self.errors[reason] += 1
+
+    def next_request(self, client, now):
+        if self.issued >= self.requests:
+            client.close()
+            return
+        self.issued += 1
+        index = bisect.bisect(self.cumulative, random.random() * self.cumulative[-1])
+        path = self.paths[min(index, len(self.paths) - 1)]
+        if '%d' in path:
+            path = path % self.issued
+        client.start_request(path, now)
+
+    def run(self):
+        self.epoll = select.epoll()
+        slow = [SlowClient(self) for _ in range(self.slow_clients)]
+        for client in slow:
+            client.connect()
+        clients = [Client(self) for _ in range(self.concurrency)]
+        started = time.time()
+        for client in clients:
+            self.next_request(client, time.time())
+        next_tick = started + self.slow_interval
+        try:
+            while self.completed < self.requests:
+                for fileno, event in self.epoll.poll(0.05):
+                    handler = self.handlers.get(fileno)
+                    if handler is not None:
+                        handler.on_event(event, time.time())
+                now = time.time()
+                for client in clients:
+                    if client.started is None:
+                        # failed clients are restarted here rather than from fail()
+                        if self.issued < self.requests:
+                            self.next_request(client, now)
+                    elif now - client.started > self.timeout:
+                        client.fail('timeout')
+                if now >= next_tick:
+                    next_tick = now + self.slow_interval
+                    for client in slow:
+                        client.tick()
+            elapsed = time.time() - started
+        finally:
+            for client in clients + slow:
+                client.close()
+            self.epoll.close()
+        return {
+            'elapsed': elapsed,
+            'latencies': self.latencies,
+            'statuses': dict(self.statuses),
+            'errors': dict(self.errors),
+            'bytes_received': self.bytes_received,
+            'slow_clients': len(slow),
+            'slow_dropped': sum(1 for client in slow if client.dropped),
+        }
+
+
+def run_worker(kwargs):
+    return Runner(**kwargs).run()
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def summarize(name, results):
+    latencies = sorted(latency for res in results for latency in res['latencies'])
+    statuses = collections.Counter()
+    errors = collections.Counter()
+    for res in results:
+        statuses.update(res['statuses'])
+        errors.update(res['errors'])
+    elapsed = max(res['elapsed'] for res in results)
+    received = sum(res['bytes_received'] for res in results)
+    return {
+        'name': name,
+        'requests': len(latencies) + sum(errors.values()),
+        'errors': dict(errors),
+        'statuses': dict((str(code), count) for code, count in statuses.items()),
+        'seconds': elapsed,
+        'rps': len(latencies) / elapsed if elapsed else 0,
+        'mb_per_sec': received / elapsed / 1024 / 1024 if elapsed else 0,
+        'latency_ms': dict((key, percentile(latencies, percent) * 1000) for key, percent in (
+            ('p50', 50), ('p99', 99), ('p999', 99.9), ('max', 100))),
+        'slow_clients': sum(res['slow_clients'] for res in results),
+        'slow_dropped': sum(res['slow_dropped'] for res in results),
+    }
+
+
+def run_scenario(name, mix, args, port):
+    procs = max(1, min(args.procs, args.concurrency))
+    kwargs = []
+    for i in range(procs):
+        kwargs.append({
+            'host': args.host, 'port': port, 'mix': mix,
+            'requests': args.requests // procs + (i < args.requests % procs),
+            'concurrency': args.concurrency // procs + (i < args.concurrency % procs),
+            'keep_alive': args.keep_alive, 'timeout': args.timeout,
+            'slow_clients': args.slow_clients // procs if name == 'slowloris' else 0,
+        })
+    if procs == 1:
+        results = [run_worker(kwargs[0])]
+    else:
+        pool = multiprocessing.Pool(procs)
+        try:
+            results = pool.map(run_worker, kwargs)
+        finally:
+            pool.close()
+            pool.join()
+    return summarize(name, results)
+
+
+def free_port(host):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((host, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(root, port, server_args):
+    httpd = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'httpd.py')
+    with open(os.devnull, 'wb') as devnull:
+        proc = subprocess.Popen([sys.executable, httpd, '-r', root, '-p', str(port)] +
+                                shlex.split(server_args), stdout=devnull, stderr=devnull)
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return proc
+        except socket.error:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.05)
+    stop_server(proc)
+    raise RuntimeError('httpd did not start with arguments %r' % server_args)
+
+
+def stop_server(proc):
+    if proc.poll() is None:
+        proc.terminate()
+    proc.wait()
+
+
+def print_result(res):
+    print('{0:<32} {1:>8} {2:>10.1f} {3:>9.1f} {4:>9.2f} {5:>9.2f} {6:>9.2f} {7:>9.2f}  {8}'.format(
+        res['name'], res['requests'], res['rps'], res['mb_per_sec'],
+        res['latency_ms']['p50'], res['latency_ms']['p99'], res['latency_ms']['p999'],
+        res['latency_ms']['max'],
+        ' '.join('%s=%s' % item for item in sorted(res['statuses'].items())) +
+        ''.join(' %s=%s' % item for item in sorted(res['errors'].items())) +
+        (' slow %s/%s dropped' % (res['slow_dropped'], res['slow_clients'])
+         if res['slow_clients'] else '')))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='load httpd.py over loopback; without --port it starts the server itself, '
+                    'once per --server-args, e.g. --server-args= --server-args=--edge-triggered')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='load an already running server '
+                        'whose root has the files from --make-root')
+    parser.add_argument('--make-root', metavar='DIR', help='write the fixture files and exit')
+    parser.add_argument('--server-args', action='append',
+                        help='httpd.py arguments, repeat to compare several setups')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS) + ['all'],
+                        help='repeat to run several, default: all')
+    parser.add_argument('--mix', type=parse_mix,
+                        help='custom path:weight list, e.g. small.html:9,image.jpg:1')
+    parser.add_argument('-n', '--requests', type=int, default=10000)
+    parser.add_argument('-c', '--concurrency', type=int, default=50)
+    parser.add_argument('--no-keepalive', dest='keep_alive', action='store_false')
+    parser.add_argument('--procs', type=int, default=1, help='client processes')
+    parser.add_argument('--timeout', type=float, default=10, help='per request timeout')
+    parser.add_argument('--slow-clients', type=int, default=200,
+                        help='connections held open by the slowloris scenario')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    if args.make_root:
+        make_root(args.make_root)
+        return
+    scenarios = args.scenario or ['all']
+    if 'all' in scenarios:
+        scenarios = ['small', 'image', '404', 'slowloris', 'mix']
+    runs = [(name, SCENARIOS[name]) for name in scenarios]
+    if args.mix:
+        runs = [('custom', args.mix)]
+
+    results = []
+    if args.port:
+        for name, mix in runs:
+            results.append(run_scenario(name, mix, args, args.port))
+    else:
+        root = tempfile.mkdtemp()
+        try:
+            make_root(root)
+            for server_args in args.server_args or ['']:
+                for name, mix in runs:
+                    # a fresh server per scenario, so slow clients don't leak into the next one
+                    port = free_port(args.host)
+                    proc = start_server(root, port, server_args)
+                    try:
+                        res = run_scenario(name, mix, args, port)
+                    finally:
+                        stop_server(proc)
+                    if server_args:
+                        res['name'] = '%s [%s]' % (name, server_args)
+                    res['server_args'] = server_args
+                    results.append(res)
+        finally:
+            shutil.rmtree(root)
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        print('{0:<32} {1:>8} {2:>10} {3:>9} {4:>9} {5:>9} {6:>9} {7:>9}  {8}'.format(
+            'scenario', 'requests', 'req/s', 'MB/s', 'p50, ms', 'p99, ms', 'p999, ms', 'max, ms',
+            'responses'))
+        for res in results:
+            print_result(res)
+
+
+if __name__ == '__main__':
+    main()
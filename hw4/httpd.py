@@ -2,43 +2,151 @@
 
 
 import argparse
+import calendar
+import collections
+import errno
+import fcntl
+import json
 import os
 import select
+import signal
 import socket
-import urllib
+import stat
+import threading
+import time
+import traceback
 from datetime import datetime as DateTime
+from email.utils import parsedate
+
+try:
+    from urllib import unquote as unquote_to_bytes
+except ImportError:
+    from urllib.parse import unquote_to_bytes
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+sendfile = getattr(os, 'sendfile', None)
+
+
+def to_native(data):
+    if str is bytes:
+        return data
+    return data.decode('latin-1')
 
 
 class HttpRequest(object):
 
-    def __init__(self):
-        self.data = ''
+    MAX_HEADER_SIZE = 8192
+
+    MAX_HEADERS = 100
+
+    def __init__(self, data=b''):
+        self.buffer = bytearray()
+        self.line_start = 0
+        self.rest = b''
         self.method = None
         self.uri = None
+        self.version = None
         self.headers = {}
+        self.header_count = 0
+        self.error = None
         self.is_valid = None
         self.is_ready = False
+        if data:
+            self.add_data(data)
 
     def add_data(self, data):
-        self.data += data
-        index = self.data.find('\r\n\r\n')
-        if index != -1:
-            try:
-                self._parse_data(self.data[:index])
+        self.buffer += data
+        try:
+            self._parse_lines()
+        except ValueError:
+            self._fail(400)
+        if not self.is_ready and len(self.buffer) > self.MAX_HEADER_SIZE:
+            self._fail(431)
+
+    def _parse_lines(self):
+        # resume from the first line that was not complete on the previous call
+        while not self.is_ready:
+            index = self.buffer.find(b'\r\n', self.line_start)
+            if index == -1:
+                return
+            if index > self.MAX_HEADER_SIZE:
+                self._fail(431)
+                return
+            line = to_native(bytes(self.buffer[self.line_start:index]))
+            self.line_start = index + 2
+            if self.method is None:
+                if line:
+                    self.method, self.uri, self.version = line.split(' ')
+            elif line:
+                self.header_count += 1
+                if self.header_count > self.MAX_HEADERS:
+                    self._fail(431)
+                    return
+                name, value = line.split(':', 1)
+                self.headers[name.strip().lower()] = value.strip()
+            else:
+                # anything after the headers is the next pipelined request
+                self.rest = bytes(self.buffer[self.line_start:])
                 self.is_valid = True
-            except:
-                self.is_valid = False
-            self.is_ready = True
+                self.is_ready = True
+
+    def _fail(self, code):
+        self.error = code
+        self.is_valid = False
+        self.is_ready = True
+
+    @property
+    def keep_alive(self):
+        if not self.is_valid:
+            return False
+        # request bodies are not read, so the stream can't be reused after them
+        if self.headers.get('content-length', '0') != '0' or 'transfer-encoding' in self.headers:
+            return False
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+    @property
+    def accepts_gzip(self):
+        # gzip;q=0 refuses it, and so does *;q=0 unless gzip is listed on its own
+        wildcard = False
+        for item in self.headers.get('accept-encoding', '').lower().split(','):
+            coding, _, params = item.partition(';')
+            coding = coding.strip()
+            if coding not in ('gzip', 'x-gzip', '*'):
+                continue
+            qvalue = 1.0
+            for param in params.split(';'):
+                name, _, value = param.partition('=')
+                if name.strip() == 'q':
+                    try:
+                        qvalue = float(value)
+                    except ValueError:
+                        qvalue = 0.0
+            if coding != '*':
+                return qvalue > 0
+            wildcard = qvalue > 0
+        return wildcard
 
-    def _parse_data(self, data):
-        lines = data.split('\r\n')
-        self.method, self.uri, ver = lines[0].split(' ')
-        for line in lines[1:]:
-            name, value = line.split(':', 1)
-            self.headers[name.strip()] = value.strip()
 
 class Resource(object):
-    
+
     content_type = {
         'html': 'text/html',
         'css': 'text/css',
@@ -50,55 +158,249 @@ class Resource(object):
         'swf': 'application/x-shockwave-flash'
     }
 
-    def __init__(self, path):
+    def __init__(self, path, variant_of=None):
         self.path = path
-        self.type = None
+        self.type = self.content_type.get((variant_of or path).rsplit('.', 1)[-1])
+        # a precompressed sibling is served in place of the file it was made from
+        self.encoding = 'gzip' if variant_of else None
         self.length = None
-        self.data = None
+        self.mtime = None
+        self.etag = None
+        self.last_modified = None
+        self.file = None
+
+    def open(self):
+        self.file = open(self.path, 'rb')
+        self._set_validators(os.fstat(self.file.fileno()))
+
+    def _set_validators(self, st):
+        self.length = st.st_size
+        self.mtime = int(st.st_mtime)
+        self.etag = '"%x-%x"' % (self.mtime, st.st_size)
+        self.last_modified = HttpResponse.httpdate(DateTime.utcfromtimestamp(self.mtime))
+
+    @property
+    def header_block(self):
+        return self._render_header_block()
+
+    def _render_header_block(self):
+        headers = 'ETag: %s\r\nLast-Modified: %s\r\n' % (self.etag, self.last_modified)
+        if self.type:
+            headers += 'Content-Type: %s\r\n' % self.type
+        if self.encoding:
+            headers += 'Content-Encoding: %s\r\nVary: Accept-Encoding\r\n' % self.encoding
+        return headers.encode('latin-1')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class CachedFile(Resource):
+
+    header_block = None
+
+    def __init__(self, path, data, st, checked, variant_of=None):
+        super(CachedFile, self).__init__(path, variant_of)
+        self._set_validators(st)
+        self.data = data
+        self.length = len(data)
+        self.st_mtime = st.st_mtime
+        self.size = st.st_size
+        self.checked = checked
+        self.header_block = self._render_header_block()
+        # complete header blocks, without Date, by (status, keep-alive)
+        self.header_cache = {}
+
+    def is_fresh(self, st):
+        return st.st_mtime == self.st_mtime and st.st_size == self.size
+
+
+class FileCache(object):
+
+    MAX_MISSING = 10000
+
+    def __init__(self, max_size, max_file_size, check_interval=1):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.check_interval = check_interval
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        # paths that did not exist at the last check, e.g. absent .gz variants
+        self.missing = {}
+        # io threads share the cache with the loop; files are stat'ed and read outside the lock
+        self.lock = threading.Lock()
+
+    def peek(self, path, variant_of=None):
+        # an entry that can be served without touching the disk, False if the path is
+        # known to be missing, None if only a stat can tell
+        now = time.time()
+        key = (path, variant_of)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                return entry if now - entry.checked < self.check_interval else None
+            if now - self.missing.get(key, 0) < self.check_interval:
+                return False
+        return None
+
+    def get(self, path, variant_of=None):
+        # an entry, False if the path is missing or not a regular file, None if
+        # the file is there but can't be cached
+        now = time.time()
+        key = (path, variant_of)
+        with self.lock:
+            entry = self._pop(key)
+            if entry is not None and now - entry.checked < self.check_interval:
+                self._add(key, entry)
+                return entry
+            if entry is None and now - self.missing.get(key, 0) < self.check_interval:
+                return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            with self.lock:
+                if len(self.missing) >= self.MAX_MISSING:
+                    self.missing.clear()
+                self.missing[key] = now
+            return False
+        if entry is not None and entry.is_fresh(st):
+            entry.checked = now
+            with self.lock:
+                self._add(key, entry)
+            return entry
+        with self.lock:
+            self.missing.pop(key, None)
+        return self._load(key, st, now)
+
+    def _load(self, key, st, now):
+        if st.st_size > self.max_file_size:
+            return None
+        path, variant_of = key
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        entry = CachedFile(path, data, st, now, variant_of)
+        with self.lock:
+            self._add(key, entry)
+        return entry
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.length
+        return entry
+
+    def _add(self, key, entry):
+        self._pop(key)
+        self.entries[key] = entry
+        self.size += entry.length
+        while self.size > self.max_size and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.length
+
+
+class FileBody(object):
+
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, resource, offset=0, length=None):
+        self.resource = resource
+        self.offset = offset
+        self.end = resource.length if length is None else offset + length
+        self.buffer = None
+        if offset and sendfile is None:
+            resource.file.seek(offset)
 
-    def load(self):
-        self.type = self.content_type.get(self.path.rsplit('.', 1)[-1])
-        with open(self.path, 'rb') as f:
-            self.data = f.read()
-        self.length = len(self.data)
+    def send(self, sock):
+        count = min(self.CHUNK_SIZE, self.end - self.offset)
+        if sendfile is not None:
+            nbytes = sendfile(sock.fileno(), self.resource.file.fileno(), self.offset, count)
+        else:
+            if not self.buffer:
+                self.buffer = memoryview(self.resource.file.read(count))
+            nbytes = len(self.buffer) and sock.send(self.buffer)
+            self.buffer = self.buffer[nbytes:]
+        if not nbytes:
+            raise IOError(errno.EIO, 'file is shorter than its Content-Length')
+        self.offset += nbytes
+        return nbytes
+
+    def is_empty(self):
+        return self.offset >= self.end
+
+    def close(self):
+        self.resource.close()
 
 
 class HttpResponse(object):
 
     DOCUMENT_ROOT = None
 
+    FILE_CACHE = None
+
     SERVER_NAME = 'My Server'
 
+    STATS_PATH = None
+
     code_desc = {
+        200: 'OK',
+        206: 'Partial Content',
+        304: 'Not Modified',
         400: 'Bad Request',
         403: 'Forbidden',
         404: 'Not Found',
-        405: 'Method Not Allowed'
+        405: 'Method Not Allowed',
+        416: 'Requested Range Not Satisfiable',
+        431: 'Request Header Fields Too Large'
     }
 
-    def __init__(self, req):
+    IOV_MAX = 64
+
+    # without sendmsg, bodies up to this size go out in the same write as the headers
+    COALESCE_SIZE = 16384
+
+    # status line and fixed headers by (status, keep-alive)
+    status_blocks = {}
+
+    date_header = (None, b'')
+
+    def __init__(self, req, keep_alive=False, stats=None):
         self.data = None
-        self.cur = 0
+        self.buffers = []
         self.headers = {}
         self.resource = None
+        self.body = None
+        self.code = None
+        self.sent = 0
+        self.keep_alive = keep_alive
+        self.stats = stats
         self._build_response(req)
+        if not hasattr(socket.socket, 'sendmsg') and len(self.buffers) == 1 and \
+                len(self.buffers[0]) <= self.COALESCE_SIZE:
+            self.data += self.buffers.pop().tobytes()
+        self.buffers.insert(0, memoryview(self.data))
 
     def _build_response(self, req):
-        self._set_headers()
         if not req.is_valid:
-            self._render4xx(400)
+            self._render4xx(req.error or 400)
         elif req.method in ('HEAD', 'GET'):
+            if self.STATS_PATH and self.stats is not None and \
+                    req.uri.split('?', 1)[0] == self.STATS_PATH:
+                self._render_stats(req)
+                return
             path = self._path_from_uri(req.uri)
             if path[:len(self.DOCUMENT_ROOT)] != self.DOCUMENT_ROOT:
                 self._render4xx(403)
                 return
-            self._load_resource(path)
+            self._load_resource(path, req)
             if self.resource:
-                self.data = 'HTTP/1.1 200 OK\r\n'
-                self._set_headers()
-                self._render_headers()
-                if req.method == 'GET':
-                    self._render_body()
+                self._render_resource(req)
             else:
                 if req.uri[-1] == '/':
                     self._render4xx(403)
@@ -108,49 +410,225 @@ class HttpResponse(object):
             self._render4xx(405)
 
     def _render4xx(self, code):
-        self.data = 'HTTP/1.1 %s %s' % (code, self.code_desc[code])
-        self._render_headers()
+        self.code = code
+        self._render_headers(self._status_block(code))
+
+    def _status_block(self, code):
+        key = (code, self.keep_alive)
+        block = self.status_blocks.get(key)
+        if block is None:
+            block = 'HTTP/1.1 %s %s\r\nServer: %s\r\nConnection: %s\r\n' % (
+                code, self.code_desc[code], self.SERVER_NAME,
+                'keep-alive' if self.keep_alive else 'close')
+            if code >= 400:
+                block += 'Content-Length: 0\r\n'
+            block = block.encode('latin-1')
+            self.status_blocks[key] = block
+        return block
+
+    def _resource_block(self, code, length):
+        # headers of whole-file responses from the file cache are built once per entry
+        resource = self.resource
+        cacheable = code != 206 and isinstance(resource, CachedFile)
+        if cacheable:
+            block = resource.header_cache.get((code, self.keep_alive))
+            if block is not None:
+                return block
+        block = self._status_block(code)
+        if code != 304:
+            block += ('Content-Length: %s\r\n' % length).encode('latin-1')
+        block += resource.header_block
+        if cacheable:
+            resource.header_cache[(code, self.keep_alive)] = block
+        return block
+
+    def _render_resource(self, req):
+        resource = self.resource
+        if self._is_not_modified(req):
+            code, start, length = 304, 0, 0
+        else:
+            byte_range = self._parse_range(req)
+            if byte_range is False:
+                self.headers['Content-Range'] = 'bytes */%s' % resource.length
+                resource.close()
+                self.resource = None
+                self._render4xx(416)
+                return
+            if byte_range is None:
+                code, start, length = 200, 0, resource.length
+            else:
+                code, start, length = 206, byte_range[0], byte_range[1] - byte_range[0] + 1
+                self.headers['Content-Range'] = 'bytes %s-%s/%s' % (
+                    byte_range[0], byte_range[1], resource.length)
+        self.code = code
+        self._render_headers(self._resource_block(code, length))
+        if req.method != 'GET' or code == 304:
+            resource.close()
+        elif isinstance(resource, CachedFile):
+            self.buffers.append(memoryview(resource.data)[start:start + length])
+        else:
+            self.body = FileBody(resource, start, length)
+
+    def _render_stats(self, req):
+        if 'format=json' in req.uri:
+            body = json.dumps(self.stats.as_dict(), sort_keys=True)
+            self.headers['Content-Type'] = 'application/json'
+        else:
+            body = self.stats.as_text()
+            self.headers['Content-Type'] = 'text/plain'
+        body = body.encode('latin-1')
+        self.headers['Content-Length'] = len(body)
+        self.headers['Cache-Control'] = 'no-cache'
+        self.code = 200
+        self._render_headers(self._status_block(200))
+        if req.method == 'GET':
+            self.buffers.append(memoryview(body))
+
+    def _is_not_modified(self, req):
+        etags = req.headers.get('if-none-match')
+        if etags is not None:
+            etags = [etag.strip() for etag in etags.split(',')]
+            return '*' in etags or self.resource.etag in etags or 'W/' + self.resource.etag in etags
+        since = req.headers.get('if-modified-since')
+        if since:
+            since = parsedate(since)
+            return since is not None and calendar.timegm(since) >= self.resource.mtime
+        return False
+
+    def _parse_range(self, req):
+        # None means serve the whole file, False means the range is unsatisfiable
+        value = req.headers.get('range')
+        if not value or not value.startswith('bytes=') or ',' in value:
+            return None
+        if_range = req.headers.get('if-range')
+        if if_range and if_range not in (self.resource.etag, self.resource.last_modified):
+            return None
+        length = self.resource.length
+        first, _, last = value[6:].strip().partition('-')
+        try:
+            if first:
+                first = int(first)
+                last = int(last) if last else max(first, length - 1)
+            else:
+                suffix = int(last)
+                if suffix == 0:
+                    return False
+                first, last = max(0, length - suffix), length - 1
+        except ValueError:
+            return None
+        if first < 0 or last < first:
+            return None
+        if first >= length:
+            return False
+        return first, min(last, length - 1)
 
-    def _path_from_uri(self, uri):
+    @classmethod
+    def needs_io(cls, req):
+        # whether building the response may block on stat, open or read
+        if not req.is_valid or req.method not in ('HEAD', 'GET'):
+            return False
+        if cls.STATS_PATH and req.uri.split('?', 1)[0] == cls.STATS_PATH:
+            return False
+        if cls.FILE_CACHE is None:
+            return True
+        path = cls._path_from_uri(req.uri)
+        if path[:len(cls.DOCUMENT_ROOT)] != cls.DOCUMENT_ROOT:
+            return False
+        # the .gz sibling is looked up for every request: either it is served, or
+        # the plain file needs Vary
+        variant = cls.FILE_CACHE.peek(path + '.gz', path)
+        if variant is None:
+            return True
+        if variant is not False and req.accepts_gzip:
+            return False
+        return not cls.FILE_CACHE.peek(path)
+
+    @classmethod
+    def _path_from_uri(cls, uri):
         if uri[-1] == '/':
             uri += 'index.html'
         if uri[0] == '/':
             uri = uri[1:]
-        path = urllib.unquote(uri).decode('utf-8')
+        path = unquote_to_bytes(uri).decode('utf-8')
         path = path.split('?', 1)[0]
-        path = os.path.join(self.DOCUMENT_ROOT, path)
+        path = os.path.join(cls.DOCUMENT_ROOT, path)
         return os.path.abspath(path)
 
-    def _load_resource(self, path):
-        if os.path.exists(path) and os.path.isfile(path):
-            self.resource = Resource(path)
-            self.resource.load()
+    def _load_resource(self, path, req):
+        if req.accepts_gzip:
+            self.resource = self._open_resource(path + '.gz', path)
+            if self.resource is not None:
+                return
+        elif self._has_variant(path):
+            # caches must not hand this response to a client that accepts gzip
+            self.headers['Vary'] = 'Accept-Encoding'
+        self.resource = self._open_resource(path)
+
+    def _has_variant(self, path):
+        if self.FILE_CACHE is not None:
+            return self.FILE_CACHE.get(path + '.gz', path) is not False
+        return os.path.isfile(path + '.gz')
 
-    def _set_headers(self):
-        self.headers['Connection'] = 'close'
-        self.headers['Date'] = self.httpdate(DateTime.utcnow())
-        self.headers['Server'] = self.SERVER_NAME
-        if self.resource:
-            if self.resource.type:
-                self.headers['Content-Type'] = self.resource.type
-            self.headers['Content-Length'] = self.resource.length
+    def _open_resource(self, path, variant_of=None):
+        if self.FILE_CACHE is not None:
+            resource = self.FILE_CACHE.get(path, variant_of)
+            if resource is False:
+                return None
+            if resource is not None:
+                return resource
+            # a regular file, but too large for the cache
+        elif not os.path.isfile(path):
+            return None
+        resource = Resource(path, variant_of)
+        resource.open()
+        return resource
 
-    def _render_headers(self):
-        for name, value in self.headers.items():
-            self.data += '%s: %s\r\n' % (name, value)
-        self.data += '\r\n'
+    def _render_headers(self, block):
+        if self.headers:
+            block += ''.join('%s: %s\r\n' % item for item in self.headers.items()).encode('latin-1')
+        self.data = block + self._date_header() + b'\r\n'
 
-    def _render_body(self):
-        self.data += self.resource.data
+    @classmethod
+    def _date_header(cls):
+        # formatted at most once a second and shared by all responses
+        now = int(time.time())
+        second, header = cls.date_header
+        if second != now:
+            header = ('Date: %s\r\n' % cls.httpdate(DateTime.utcfromtimestamp(now))).encode('latin-1')
+            cls.date_header = (now, header)
+        return header
 
-    def read(self, nbytes):
-        return self.data[self.cur: self.cur+nbytes]
+    def send(self, sock):
+        # write until everything is sent or the socket buffer is full
+        try:
+            while self.buffers:
+                if hasattr(sock, 'sendmsg'):
+                    nbytes = sock.sendmsg(self.buffers[:self.IOV_MAX])
+                else:
+                    nbytes = sock.send(self.buffers[0])
+                self._consume(nbytes)
+                self.sent += nbytes
+            while self.body is not None and not self.body.is_empty():
+                self.sent += self.body.send(sock)
+        except (socket.error, OSError, IOError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
 
-    def seek(self, nbytes):
-        self.cur += nbytes
+    def _consume(self, nbytes):
+        while nbytes:
+            first = self.buffers[0]
+            if nbytes < len(first):
+                self.buffers[0] = first[nbytes:]
+                return
+            nbytes -= len(first)
+            self.buffers.pop(0)
 
     def is_empty(self):
-        return self.cur >= len(self.data)
+        return not self.buffers and (self.body is None or self.body.is_empty())
+
+    def close(self):
+        if self.body is not None:
+            self.body.close()
 
     @staticmethod
     def httpdate(dt):
@@ -161,92 +639,698 @@ class HttpResponse(object):
                                                     dt.year, dt.hour, dt.minute, dt.second)
 
 
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+class TimerWheel(object):
+
+    def __init__(self, timeout, resolution=1):
+        self.timeout = timeout
+        self.resolution = resolution
+        self.slots = [set() for _ in range(int(timeout / resolution) + 3)]
+        self.deadlines = {}
+        self.tick = self._tick(time.time())
+
+    def _tick(self, moment):
+        return int(moment / self.resolution) + 1
+
+    def add(self, fileno, now):
+        deadline = now + self.timeout
+        self.deadlines[fileno] = deadline
+        self.slots[self._tick(deadline) % len(self.slots)].add(fileno)
+
+    def touch(self, fileno, now):
+        # entries are moved to their new slot lazily, when the old slot expires
+        self.deadlines[fileno] = now + self.timeout
+
+    def remove(self, fileno):
+        self.deadlines.pop(fileno, None)
+
+    def expire(self, now):
+        expired = []
+        current = self._tick(now) - 1
+        self.tick = max(self.tick, current - len(self.slots) + 1)
+        while self.tick <= current:
+            index = self.tick % len(self.slots)
+            slot, self.slots[index] = self.slots[index], set()
+            for fileno in slot:
+                deadline = self.deadlines.get(fileno)
+                if deadline is None:
+                    continue
+                if deadline <= now:
+                    expired.append(fileno)
+                    del self.deadlines[fileno]
+                else:
+                    tick = max(self._tick(deadline), current + 1)
+                    self.slots[tick % len(self.slots)].add(fileno)
+            self.tick += 1
+        return expired
+
+    def next_timeout(self, now):
+        return max(0, self.tick * self.resolution - now)
+
+
+class LatencyHistogram(object):
+
+    # log-linear buckets in microseconds, like HdrHistogram: every power of two
+    # range is split into 128 buckets, so the relative error stays below 1%
+    SUB_BUCKET_BITS = 8
+
+    def __init__(self):
+        self.half = 1 << (self.SUB_BUCKET_BITS - 1)
+        self.counts = [0] * (2 * self.half)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        shift = value.bit_length() - self.SUB_BUCKET_BITS
+        index = value if shift <= 0 else shift * self.half + (value >> shift)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def _bucket_limit(self, index):
+        if index < 2 * self.half:
+            return index
+        shift = index // self.half - 1
+        return ((index - shift * self.half + 1) << shift) - 1
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        rank = max(1, int(self.count * percent / 100.0 + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._bucket_limit(index), self.max)
+        return self.max
+
+    def as_dict(self):
+        result = {'count': self.count, 'max': self.max,
+                  'mean': self.total // self.count if self.count else 0}
+        for name, percent in (('p50', 50), ('p90', 90), ('p99', 99), ('p999', 99.9)):
+            result[name] = self.percentile(percent)
+        return result
+
+
+class ServerStats(object):
+
+    def __init__(self):
+        self.started = time.time()
+        self.accepted = 0
+        self.closed = 0
+        self.bytes_sent = 0
+        self.responses = collections.defaultdict(int)
+        self.latency = LatencyHistogram()
+
+    def as_dict(self):
+        return {
+            'pid': os.getpid(),
+            'uptime': round(time.time() - self.started, 3),
+            'connections': {'accepted': self.accepted,
+                            'active': self.accepted - self.closed,
+                            'closed': self.closed},
+            'bytes_sent': self.bytes_sent,
+            'responses': dict((str(code), count) for code, count in self.responses.items()),
+            'latency_us': self.latency.as_dict()
+        }
+
+    def as_text(self):
+        stats = self.as_dict()
+        lines = ['pid %s' % stats['pid'], 'uptime %s' % stats['uptime']]
+        for name in ('accepted', 'active', 'closed'):
+            lines.append('connections_%s %s' % (name, stats['connections'][name]))
+        lines.append('bytes_sent %s' % stats['bytes_sent'])
+        for code in sorted(stats['responses']):
+            lines.append('responses_%s %s' % (code, stats['responses'][code]))
+        for name in ('count', 'mean', 'p50', 'p90', 'p99', 'p999', 'max'):
+            lines.append('latency_us_%s %s' % (name, stats['latency_us'][name]))
+        return '\n'.join(lines) + '\n'
+
+
+class IoPool(object):
+
+    def __init__(self, threads):
+        self.jobs = queue.Queue()
+        self.results = collections.deque()
+        # finished jobs wake the event loop through an eventfd, or a self-pipe without one
+        if hasattr(os, 'eventfd'):
+            self.wakeup_fd = self.notify_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self.wakeup_fd, self.notify_fd = os.pipe()
+            for fd in (self.wakeup_fd, self.notify_fd):
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, func, *args):
+        self.jobs.put((key, func, args))
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            key, func, args = job
+            try:
+                self.results.append((key, func(*args), None))
+            except Exception as e:
+                traceback.print_exc()
+                self.results.append((key, None, e))
+            try:
+                os.write(self.notify_fd, b'\x01\0\0\0\0\0\0\0')
+            except OSError as e:
+                # a full pipe already guarantees a wakeup
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+    def finished(self):
+        try:
+            while os.read(self.wakeup_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        while self.results:
+            yield self.results.popleft()
+
+    def close(self):
+        for _ in self.threads:
+            self.jobs.put(None)
+        os.close(self.wakeup_fd)
+        if self.notify_fd != self.wakeup_fd:
+            os.close(self.notify_fd)
+
+
 class HttpServer(object):
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, reuse_port=False, keepalive_timeout=15, keepalive_requests=100,
+                 recv_size=65536, backlog=socket.SOMAXCONN, edge_triggered=False, io_threads=0):
         self.host = host
         self.port = port
+        self.reuse_port = reuse_port
+        self.recv_size = recv_size
+        self.keepalive_timeout = keepalive_timeout
+        self.keepalive_requests = keepalive_requests
+        self.backlog = backlog
+        self.edge_triggered = edge_triggered
+        self.io_threads = io_threads
+        self.io_pool = None
         self.epoll = None
         self.servsock = None
         self.clients = {}
         self.requests = {}
         self.responses = {}
+        self.served = {}
+        self.started = {}
+        # connections waiting for an io thread to build their response
+        self.pending = {}
+        self.idle = None
+        self.stats = ServerStats()
 
     def start(self):
+        self.bind()
+        self.serve_forever()
+
+    def bind(self):
+        self.servsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.servsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.servsock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.servsock.bind((self.host, self.port))
+        self.servsock.listen(self.backlog)
+        self.servsock.setblocking(0)
+
+    def serve_forever(self):
         self.epoll = select.epoll()
-        self._bind()
+        self.idle = TimerWheel(self.keepalive_timeout)
+        if self.edge_triggered:
+            self.epoll.register(self.servsock.fileno(), select.EPOLLIN | select.EPOLLET)
+        else:
+            self.epoll.register(self.servsock.fileno(), select.EPOLLIN)
+        if self.io_threads:
+            self.io_pool = IoPool(self.io_threads)
+            self.epoll.register(self.io_pool.wakeup_fd, select.EPOLLIN)
         try:
             while True:
                 self._handle_events()
         finally:
             self._close()
 
-    def _bind(self):
-        self.servsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.servsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.servsock.bind((self.host, self.port))
-        self.servsock.listen(50)
-        self.servsock.setblocking(0)
-        self.epoll.register(self.servsock.fileno(), select.EPOLLIN)
-
     def _handle_events(self):
-        events = self.epoll.poll(1)
+        # wake up no later than the next timer wheel tick
+        events = self.epoll.poll(self.idle.next_timeout(time.time()))
         for fileno, event in events:
             if fileno == self.servsock.fileno():
-                self._accept_client()
+                self._accept_clients()
+            elif self.io_pool is not None and fileno == self.io_pool.wakeup_fd:
+                self._finish_io()
+            elif self.edge_triggered and event & (select.EPOLLIN | select.EPOLLOUT):
+                self._serve_client(fileno)
             elif event & select.EPOLLIN:
                 self._read_from_client(fileno)
             elif event & select.EPOLLOUT:
                 self._write_to_client(fileno)
             elif event & select.EPOLLHUP:
                 self._close_client(fileno)
+        self._close_idle_clients()
 
-    def _accept_client(self):
-        client, addr = self.servsock.accept()
-        client.setblocking(0)
-        self.epoll.register(client.fileno(), select.EPOLLIN)
-        self.clients[client.fileno()] = client
-        self.requests[client.fileno()] = HttpRequest()
+    def _accept_clients(self):
+        # take the whole burst off the backlog
+        while True:
+            try:
+                client, addr = self.servsock.accept()
+            except socket.error as e:
+                # the backlog is empty or another worker sharing the socket took the connection
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            client.setblocking(0)
+            # headers and a sendfile body are separate writes; with Nagle the body
+            # waits for the client's delayed ack of the headers
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.edge_triggered:
+                self.epoll.register(client.fileno(),
+                                    select.EPOLLIN | select.EPOLLOUT | select.EPOLLET)
+            else:
+                self.epoll.register(client.fileno(), select.EPOLLIN)
+            self.clients[client.fileno()] = client
+            self.requests[client.fileno()] = HttpRequest()
+            self.served[client.fileno()] = 0
+            now = time.time()
+            self.started[client.fileno()] = now
+            self.idle.add(client.fileno(), now)
+            self.stats.accepted += 1
+
+    def _serve_client(self, fileno):
+        # an edge is reported once, so read and write until the socket would block
+        while fileno in self.clients and fileno not in self.pending:
+            resp = self.responses.get(fileno)
+            if resp is not None:
+                self._write_to_client(fileno)
+                if self.responses.get(fileno) is resp:
+                    return
+            elif not self._read_from_client(fileno):
+                return
 
     def _read_from_client(self, fileno):
-        data = self.clients[fileno].recv(1024)
+        try:
+            data = self.clients[fileno].recv(self.recv_size)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            data = None
+        if not data:
+            self._close_client(fileno)
+            return False
+        now = time.time()
+        self.idle.touch(fileno, now)
+        if fileno not in self.started:
+            self.started[fileno] = now
         req = self.requests[fileno]
         req.add_data(data)
         if req.is_ready:
+            self._respond(fileno, req)
+        return True
+
+    def _respond(self, fileno, req):
+        self.served[fileno] += 1
+        keep_alive = req.keep_alive and self.served[fileno] < self.keepalive_requests
+        if self.io_pool is not None and HttpResponse.needs_io(req):
+            token = object()
+            self.pending[fileno] = token
+            self.io_pool.submit((fileno, token), HttpResponse, req, keep_alive, self.stats)
+            if not self.edge_triggered:
+                self.epoll.modify(fileno, 0)
+            return
+        self._start_response(fileno, HttpResponse(req, keep_alive, self.stats))
+
+    def _start_response(self, fileno, resp):
+        self.responses[fileno] = resp
+        if not self.edge_triggered:
             self.epoll.modify(fileno, select.EPOLLOUT)
-            self.responses[fileno] = HttpResponse(req)
+
+    def _finish_io(self):
+        for (fileno, token), resp, error in self.io_pool.finished():
+            if self.pending.get(fileno) is not token:
+                # the client went away, its descriptor may belong to a new one by now
+                if resp is not None:
+                    resp.close()
+                continue
+            del self.pending[fileno]
+            if error is not None:
+                self._close_client(fileno)
+                continue
+            self._start_response(fileno, resp)
+            if self.edge_triggered:
+                self._serve_client(fileno)
 
     def _write_to_client(self, fileno):
         client = self.clients[fileno]
         resp = self.responses[fileno]
-        data = resp.read(1024)
-        nbytes = client.send(data)
-        resp.seek(nbytes)
+        try:
+            resp.send(client)
+        except (socket.error, OSError, IOError):
+            self._close_client(fileno)
+            return
+        now = time.time()
+        self.idle.touch(fileno, now)
         if resp.is_empty():
-            client.shutdown(socket.SHUT_RDWR)
+            self.stats.responses[resp.code] += 1
+            self.stats.latency.record(int((now - self.started.pop(fileno, now)) * 1000000))
+            if resp.keep_alive:
+                self._next_request(fileno)
+            else:
+                try:
+                    client.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                self._close_client(fileno)
+
+    def _next_request(self, fileno):
+        self._close_response(fileno)
+        req = HttpRequest(self.requests[fileno].rest)
+        self.requests[fileno] = req
+        if req.buffer:
+            self.started[fileno] = time.time()
+        if req.is_ready:
+            self._respond(fileno, req)
+        elif not self.edge_triggered:
+            self.epoll.modify(fileno, select.EPOLLIN)
+
+    def _close_idle_clients(self):
+        for fileno in self.idle.expire(time.time()):
             self._close_client(fileno)
-        
+
     def _close_client(self, fileno):
         self.epoll.unregister(fileno)
         self.requests.pop(fileno, None)
-        self.responses.pop(fileno, None)
+        self._close_response(fileno)
+        self.served.pop(fileno, None)
+        self.started.pop(fileno, None)
+        self.pending.pop(fileno, None)
+        self.idle.remove(fileno)
         client = self.clients.pop(fileno, None)
         if client:
             client.close()
+            self.stats.closed += 1
+
+    def _close_response(self, fileno):
+        resp = self.responses.pop(fileno, None)
+        if resp is not None:
+            self.stats.bytes_sent += resp.sent
+            resp.close()
 
     def _close(self):
+        if self.io_pool is not None:
+            self.epoll.unregister(self.io_pool.wakeup_fd)
+            self.io_pool.close()
         self.epoll.unregister(self.servsock.fileno())
         self.epoll.close()
         self.servsock.close()
 
+class HttpProtocol(asyncio.Protocol if asyncio is not None else object):
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.request = HttpRequest()
+        self.response = None
+        self.response_size = 0
+        self.sending = None
+        self.paused = False
+        self.served = 0
+        self.started = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # asyncio only sets TCP_NODELAY when the socket's proto is IPPROTO_TCP, and
+        # it is 0 for ours; without it the sendfile body waits for the ack of the headers
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.started = time.time()
+        self.server.idle.add(self, self.started)
+        self.server.stats.accepted += 1
+
+    def connection_lost(self, exc):
+        self.server.idle.remove(self)
+        self.server.stats.closed += 1
+        if self.sending is not None:
+            self.sending.cancel()
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+
+    def data_received(self, data):
+        now = time.time()
+        self.server.idle.touch(self, now)
+        if self.started is None:
+            self.started = now
+        self.request.add_data(data)
+        if self.request.is_ready:
+            self._respond()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        if self.response is not None and self.response.body is not None and self.sending is None:
+            self._write_body()
+
+    def _respond(self):
+        if self.transport.is_closing():
+            return
+        req = self.request
+        self.served += 1
+        keep_alive = req.keep_alive and self.served < self.server.keepalive_requests
+        resp = HttpResponse(req, keep_alive, self.server.stats)
+        self.response = resp
+        # pipelined requests wait in the kernel until this response is written
+        self.transport.pause_reading()
+        self.server.idle.remove(self)
+        self.response_size = sum(len(buf) for buf in resp.buffers)
+        self.transport.writelines(resp.buffers)
+        body = resp.body
+        if body is None:
+            self._finish()
+            return
+        self.response_size += body.end - body.offset
+        if self.server.use_sendfile:
+            self.sending = asyncio.ensure_future(self.server.loop.sendfile(
+                self.transport, body.resource.file, body.offset, body.end - body.offset))
+            self.sending.add_done_callback(self._body_sent)
+        else:
+            body.resource.file.seek(body.offset)
+            self._write_body()
+
+    def _body_sent(self, future):
+        self.sending = None
+        if future.cancelled():
+            return
+        error = future.exception()
+        if isinstance(error, NotImplementedError):
+            # the loop has no sendfile, e.g. uvloop
+            self.server.use_sendfile = False
+            self.response.body.resource.file.seek(self.response.body.offset)
+            self._write_body()
+        elif error is not None:
+            self.transport.abort()
+        else:
+            self.response.body.offset = self.response.body.end
+            self._finish()
+
+    def _write_body(self):
+        body = self.response.body
+        while not self.paused and not body.is_empty():
+            chunk = body.resource.file.read(min(FileBody.CHUNK_SIZE, body.end - body.offset))
+            if not chunk:
+                self.transport.abort()
+                return
+            self.transport.write(chunk)
+            body.offset += len(chunk)
+        if body.is_empty():
+            self._finish()
+
+    def _finish(self):
+        resp, self.response = self.response, None
+        resp.close()
+        now = time.time()
+        stats = self.server.stats
+        stats.responses[resp.code] += 1
+        stats.bytes_sent += self.response_size
+        stats.latency.record(int((now - self.started) * 1000000))
+        if not resp.keep_alive:
+            self.transport.close()
+            return
+        self.request = HttpRequest(self.request.rest)
+        self.started = now if self.request.buffer else None
+        self.server.idle.add(self, now)
+        if self.request.is_ready:
+            self.server.loop.call_soon(self._respond)
+        else:
+            self.transport.resume_reading()
+
+
+class AsyncHttpServer(HttpServer):
+
+    def __init__(self, host, port, reuse_port=False, keepalive_timeout=15, keepalive_requests=100,
+                 backlog=socket.SOMAXCONN, use_uvloop=False):
+        super(AsyncHttpServer, self).__init__(host, port, reuse_port, keepalive_timeout,
+                                              keepalive_requests, backlog=backlog)
+        self.use_uvloop = use_uvloop
+        self.use_sendfile = True
+        self.loop = None
+
+    def serve_forever(self):
+        self.loop = uvloop.new_event_loop() if self.use_uvloop else asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.idle = TimerWheel(self.keepalive_timeout)
+        server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: HttpProtocol(self), sock=self.servsock, backlog=self.backlog))
+        self._close_idle_clients()
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+            self.loop.close()
+
+    def _close_idle_clients(self):
+        now = time.time()
+        for protocol in self.idle.expire(now):
+            protocol.transport.close()
+        self.loop.call_later(self.idle.next_timeout(now) or self.idle.resolution,
+                             self._close_idle_clients)
+
+
+class PreforkServer(object):
+
+    RESTART_DELAY = 1
+
+    def __init__(self, server, workers):
+        self.server = server
+        self.workers = workers
+        self.children = {}
+
+    def start(self):
+        if not self.server.reuse_port:
+            self.server.bind()
+        signal.signal(signal.SIGTERM, self._terminate)
+        try:
+            for _ in range(self.workers):
+                self._spawn()
+            while True:
+                pid, status = os.wait()
+                started = self.children.pop(pid, None)
+                if started is not None:
+                    if time.time() - started < self.RESTART_DELAY:
+                        time.sleep(self.RESTART_DELAY)
+                    self._spawn()
+        finally:
+            self._stop()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                if self.server.reuse_port:
+                    self.server.bind()
+                self.server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            os._exit(code)
+        self.children[pid] = time.time()
+
+    def _stop(self):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.children.clear()
+
+    @staticmethod
+    def _terminate(signum, frame):
+        raise SystemExit(0)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-r', help='set a root directory')
     parser.add_argument('-p', help='set a port', type=int, default=80)
+    parser.add_argument('-w', help='set a number of worker processes', type=int, default=1)
+    parser.add_argument('--reuseport', help='bind a socket per worker with SO_REUSEPORT',
+                        action='store_true')
+    parser.add_argument('--keepalive-timeout', help='close idle connections after N seconds',
+                        type=float, default=15)
+    parser.add_argument('--keepalive-requests', help='set max requests per connection',
+                        type=int, default=100)
+    parser.add_argument('--backlog', help='set a listen queue length',
+                        type=int, default=socket.SOMAXCONN)
+    parser.add_argument('--engine', help='use the epoll loop or an asyncio event loop',
+                        choices=['epoll', 'asyncio', 'uvloop'], default='epoll')
+    parser.add_argument('--edge-triggered', help='use edge-triggered epoll notifications',
+                        action='store_true')
+    parser.add_argument('--io-threads', help='open, stat and read files not in the cache '
+                        'in N threads, 0 does it in the event loop', type=int, default=0)
+    parser.add_argument('--recv-size', help='set a socket read size in bytes',
+                        type=int, default=65536)
+    parser.add_argument('--max-header-size', help='reject requests with larger headers',
+                        type=int, default=HttpRequest.MAX_HEADER_SIZE)
+    parser.add_argument('--max-headers', help='reject requests with more header fields',
+                        type=int, default=HttpRequest.MAX_HEADERS)
+    parser.add_argument('--stats-path', help='serve server statistics at this path, e.g. /__stats')
+    parser.add_argument('--cache-size', help='set a hot file cache size in MB, 0 disables it',
+                        type=float, default=64)
+    parser.add_argument('--cache-file-size', help='cache only files up to N KB',
+                        type=float, default=256)
+    parser.add_argument('--cache-check', help='stat cached files at most every N seconds',
+                        type=float, default=1)
     args = parser.parse_args()
+    if args.engine != 'epoll' and asyncio is None:
+        parser.error('the %s engine needs Python 3' % args.engine)
+    if args.engine == 'uvloop' and uvloop is None:
+        parser.error('uvloop is not installed')
+    HttpRequest.MAX_HEADER_SIZE = args.max_header_size
+    HttpRequest.MAX_HEADERS = args.max_headers
     HttpResponse.DOCUMENT_ROOT = args.r
-    server = HttpServer('127.0.0.1', args.p)
-    server.start()
+    HttpResponse.STATS_PATH = args.stats_path
+    if args.cache_size > 0:
+        HttpResponse.FILE_CACHE = FileCache(int(args.cache_size * 1024 * 1024),
+                                            int(args.cache_file_size * 1024), args.cache_check)
+    if args.engine == 'epoll':
+        server = HttpServer('127.0.0.1', args.p, args.reuseport, args.keepalive_timeout,
+                            args.keepalive_requests, args.recv_size, args.backlog,
+                            args.edge_triggered, args.io_threads)
+    else:
+        server = AsyncHttpServer('127.0.0.1', args.p, args.reuseport, args.keepalive_timeout,
+                                 args.keepalive_requests, args.backlog, args.engine == 'uvloop')
+    if args.w > 1:
+        PreforkServer(server, args.w).start()
+    else:
+        server.start()
 
 
 if __name__ == '__main__':